@@ -0,0 +1,226 @@
+# coding: utf-8
+
+'''
+Local stand-in for a Fever° API server, for benchmarks
+
+Serves a generated set of groups, feeds, favicons, links and items. Item
+bodies are generated from the item id when asked for, so only the read and
+saved flags are held in memory and half a million items is fine. Run it on
+its own to point the app at it:
+
+    python bench/fake_fever.py [items] [latency_ms] [port]
+'''
+
+import base64
+import gzip
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim',
+         'minim', 'veniam', 'quis', 'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip',
+         'commodo', 'consequat', 'duis', 'aute', 'irure', 'reprehenderit', 'voluptate', 'velit', 'esse')
+
+# 1x1 gif, every feed gets the same icon
+favicon_data = 'image/gif;base64,' + base64.b64encode(
+    b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,'
+    b'\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;').decode('ascii')
+
+page_size = 50
+
+
+class FakeFever(object):
+    '''
+    The dataset and the Fever API calls over it
+    '''
+
+    def __init__(self, items=10000, feeds=200, groups=12, unread=0.1, saved=0.01,
+                 html_words=300, latency=0.0, api_key=None, seed=1):
+        self.count = items
+        self.feed_count = feeds
+        self.group_count = groups
+        self.html_words = html_words
+        self.latency = latency
+        self.api_key = api_key
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.now = int(time.time())
+        self.last_refreshed = self.now
+        rnd = random.Random(seed)
+        # one byte per item: bit 0 read, bit 1 saved
+        self.state = bytearray(items + 1)
+        for i in range(1, items + 1):
+            self.state[i] = (rnd.random() >= unread) | (rnd.random() < saved) << 1
+
+    def feedOf(self, item_id):
+        return item_id * 7919 % self.feed_count + 1
+
+    def groupOf(self, feed_id):
+        return feed_id % self.group_count + 1
+
+    def createdOn(self, item_id):
+        # newest item is an hour old, one every ten minutes before that
+        return self.now - 3600 - (self.count - item_id) * 600
+
+    def addItems(self, count):
+        '''
+        New items arrive unread and the server refreshes
+        '''
+        with self.lock:
+            self.state.extend(b'\x00' * count)
+            self.count += count
+            self.now = int(time.time())
+            self.last_refreshed = self.now
+
+    def item(self, item_id):
+        rnd = random.Random(self.seed * 1000003 + item_id)
+        state = self.state[item_id]
+        body = ' '.join(rnd.choice(words) for _ in range(self.html_words))
+        return {'id': item_id, 'feed_id': self.feedOf(item_id),
+                'title': ' '.join(rnd.choice(words) for _ in range(6)).capitalize(),
+                'author': 'author %d' % (item_id % 50), 'html': '<p>' + body + '</p>',
+                'url': 'http://example.com/item/%d' % item_id,
+                'is_saved': state >> 1 & 1, 'is_read': state & 1,
+                'created_on_time': self.createdOn(item_id)}
+
+    def groups(self):
+        return [{'id': g, 'title': 'Group %d' % g} for g in range(1, self.group_count + 1)]
+
+    def feedsGroups(self):
+        members = {}
+        for f in range(1, self.feed_count + 1):
+            members.setdefault(self.groupOf(f), []).append(str(f))
+        return [{'group_id': g, 'feed_ids': ','.join(feeds)} for g, feeds in sorted(members.items())]
+
+    def feeds(self):
+        return [{'id': f, 'favicon_id': f, 'title': 'Feed %d' % f, 'url': 'http://example.com/feed/%d' % f,
+                 'site_url': 'http://example.com/%d' % f, 'is_spark': int(f % 25 == 0),
+                 'last_updated_on_time': self.now - f * 900} for f in range(1, self.feed_count + 1)]
+
+    def favicons(self):
+        return [{'id': f, 'data': favicon_data} for f in range(1, self.feed_count + 1)]
+
+    def links(self):
+        return [{'id': l, 'feed_id': l, 'item_id': l, 'temperature': 50.5, 'is_item': 1, 'is_local': 1,
+                 'is_saved': 0, 'title': 'Link %d' % l, 'url': 'http://example.com/link/%d' % l,
+                 'item_ids': str(l)} for l in range(1, min(self.count, 20) + 1)]
+
+    def items(self, args):
+        if 'with_ids' in args:
+            ids = [int(i) for i in args['with_ids'].split(',') if i][:page_size]
+            ids = [i for i in ids if 0 < i <= self.count]
+        elif 'max_id' in args:
+            top = min(int(args['max_id'] or 0), self.count + 1)
+            ids = range(top - 1, max(top - 1 - page_size, 0), -1)
+        else:
+            since = args.get('since_id') or '0'
+            since = 0 if since == 'None' else int(since)
+            ids = range(since + 1, min(since + page_size, self.count) + 1)
+        return [self.item(i) for i in ids]
+
+    def mark(self, form):
+        target = int(form.get('id', 0))
+        bit = 1 if form.get('as') in ('read', 'unread') else 2
+        on = form.get('as') in ('read', 'saved')
+        if form.get('mark') == 'item':
+            ids = [target] if 0 < target <= self.count else []
+        else:
+            before = int(form.get('before') or self.now)
+            if form.get('mark') == 'feed':
+                feeds = set([target])
+            else:
+                feeds = set(f for f in range(1, self.feed_count + 1) if self.groupOf(f) == target)
+            ids = [i for i in range(1, self.count + 1)
+                   if self.feedOf(i) in feeds and self.createdOn(i) <= before]
+        for i in ids:
+            self.state[i] = self.state[i] | bit if on else self.state[i] & ~bit
+
+    def handle(self, query, form):
+        args = dict(parse_qsl(query, keep_blank_values=True))
+        with self.lock:
+            self.requests += 1
+            if self.api_key and form.get('api_key') != self.api_key:
+                return {'api_version': 3, 'auth': 0}
+            if 'mark' in form:
+                self.mark(form)
+            r = {'api_version': 3, 'auth': 1, 'last_refreshed_on_time': self.last_refreshed}
+            if 'groups' in args:
+                r['groups'] = self.groups()
+                r['feeds_groups'] = self.feedsGroups()
+            if 'feeds' in args:
+                r['feeds'] = self.feeds()
+                r['feeds_groups'] = self.feedsGroups()
+            if 'favicons' in args:
+                r['favicons'] = self.favicons()
+            if 'links' in args:
+                r['links'] = self.links()
+            if 'unread_item_ids' in args:
+                r['unread_item_ids'] = ','.join(str(i) for i in range(1, self.count + 1) if not self.state[i] & 1)
+            if 'saved_item_ids' in args:
+                r['saved_item_ids'] = ','.join(str(i) for i in range(1, self.count + 1) if self.state[i] & 2)
+            if 'items' in args:
+                r['total_items'] = self.count
+                r['items'] = self.items(args)
+        return r
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let them wait on acks
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        fever = self.server.fever
+        if fever.latency:
+            time.sleep(fever.latency)
+        body = json.dumps(fever.handle(urlsplit(self.path).query, form)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body, 5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(fever, port=0):
+    '''
+    Starts the server on a background thread, returns it and the api url
+    '''
+    server = Server(('127.0.0.1', port), Handler)
+    server.fever = fever
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d/?api' % server.server_address[1]
+
+
+if __name__ == '__main__':
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8080
+    server, url = serve(FakeFever(items, latency=latency), port)
+    print('serving %d items on %s' % (items, url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
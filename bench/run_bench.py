@@ -0,0 +1,192 @@
+# coding: utf-8
+
+'''
+Sync and query benchmarks for Feverista°
+
+Starts the fake Fever server from fake_fever.py, syncs a throwaway database
+from it and times the sync paths, the group/feed/item getters for every
+view and markAsRead. Results are written as JSON keyed by the git commit so
+two runs can be compared:
+
+    python bench/run_bench.py --items 50000 --latency 20
+    python bench/run_bench.py --compare results/abc1234.json results/def5678.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from fake_fever import FakeFever, serve
+from search_bench import loadApp
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+view_types = ('Saved', 'Unread', 'All Items', 'Archived')
+
+
+def gitCommit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--'], cwd=here) != 0
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def summary(times):
+    times = sorted(times)
+    return OrderedDict([('n', len(times)),
+                        ('p50_ms', times[len(times) // 2]),
+                        ('p95_ms', times[-(-len(times) * 95 // 100) - 1]),
+                        ('mean_ms', sum(times) / len(times)),
+                        ('min_ms', times[0])])
+
+
+def timed(fn, repeat=1, before=None):
+    times = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return summary(times)
+
+
+def run(items, latency, repeat, html_words):
+    workdir = tempfile.mkdtemp(prefix='fvr_bench_')
+    # the article and image caches are relative to the working directory
+    os.chdir(workdir)
+    app = loadApp()
+    fever = FakeFever(items, html_words=html_words, latency=latency / 1000.0, api_key=app.api_key)
+    server, url = serve(fever)
+    app.baseurl = url
+    app.readurl = ''
+    app.default_account.db = app.ConnectionManager(os.path.join(workdir, 'bench.db'))
+
+    results = OrderedDict()
+    results['createDb'] = timed(app.migrateDb)
+    results['sync cold'] = timed(app.refreshAll)
+    results['sync warm no-op'] = timed(app.refreshAll, repeat)
+    results['sync warm full'] = timed(lambda: app.refreshAll(full=True), max(repeat // 4, 1))
+    results['sync 100 new items'] = timed(app.refreshAll, max(repeat // 4, 1),
+                                          before=lambda: fever.addItems(100))
+
+    # every item list query should seek its indexes, see view_filters
+    plan_scans = app.checkQueryPlans()
+
+    for view in view_types:
+        app.view_type = view
+        results['getGroups %s' % view] = timed(app.getGroups, repeat)
+        results['getFeeds %s' % view] = timed(lambda: app.getFeeds('1', '%'), repeat)
+        results['getItems %s' % view] = timed(lambda: app.getItems('1', '%'), max(repeat // 4, 1))
+        results['getItemsPage %s' % view] = timed(lambda: app.getItemsPage('%', '%'), repeat)
+
+    def startup():
+        # a fresh process's first connection, schema check and groups list
+        app.default_account.db.close()
+        app.default_account.db = app.ConnectionManager(os.path.join(workdir, 'bench.db'))
+        app.migrateDb()
+        app.getGroups()
+    app.view_type = 'Unread'
+    results['startup to groups'] = timed(startup, repeat)
+
+    # memory held by a whole Unread list, per row
+    app.view_type = 'Unread'
+    tracemalloc.start()
+    item_list = app.getItems('%', '%')
+    item_bytes = tracemalloc.get_traced_memory()[0] / max(len(item_list), 1)
+    tracemalloc.stop()
+    del item_list
+
+    with app.db.reader() as conn:
+        unread = [row[0] for row in conn.execute(
+            'SELECT id FROM items WHERE is_read = 0 ORDER BY id LIMIT ?', (repeat,))]
+    marks = iter(unread)
+    results['markAsRead item'] = timed(lambda: app.markAsRead('item', next(marks)), len(unread))
+
+    def drained():
+        while True:
+            with app.db.reader() as conn:
+                if not conn.execute('SELECT count(*) FROM outbox').fetchone()[0]:
+                    return
+            time.sleep(0.005)
+    results['outbox drain'] = timed(drained)
+
+    db_bytes = sum(os.path.getsize(os.path.join(workdir, name))
+                   for name in os.listdir(workdir) if name.startswith('bench.db'))
+    server.shutdown()
+    app.db.close()
+    return OrderedDict([
+        ('commit', gitCommit()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('params', OrderedDict([('items', items), ('latency_ms', latency),
+                                ('repeat', repeat), ('html_words', html_words)])),
+        ('env', OrderedDict([('python', platform.python_version()), ('sqlite', sqlite3.sqlite_version),
+                             ('platform', platform.platform())])),
+        ('db_bytes', db_bytes),
+        ('item_list_bytes_per_row', item_bytes),
+        ('server_requests', fever.requests),
+        ('api', app.fever.stats),
+        ('query_plan_scans', plan_scans),
+        ('results', results)])
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('%-28s %12s %12s %8s' % ('p50 ms', old['commit'], new['commit'], 'change'))
+    for name in OrderedDict.fromkeys(list(old['results']) + list(new['results'])):
+        a = old['results'].get(name, {}).get('p50_ms')
+        b = new['results'].get(name, {}).get('p50_ms')
+        change = '%+7.1f%%' % ((b - a) / a * 100) if a and b else ''
+        print('%-28s %12s %12s %8s' % (name, '%.2f' % a if a is not None else '-',
+                                       '%.2f' % b if b is not None else '-', change))
+    if old['params'] != new['params']:
+        print('note: the runs used different parameters %r %r' % (old['params'], new['params']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=10000, help='items on the fake server, 10k to 500k')
+    parser.add_argument('--latency', type=float, default=0, help='added server latency per request in ms')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per timed step')
+    parser.add_argument('--html-words', type=int, default=300, help='words per article body')
+    parser.add_argument('--out', help='results file, default results/<commit>.json next to this script')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # run() changes directory, so resolve --out first
+    out = os.path.abspath(args.out) if args.out else None
+    report = run(args.items, args.latency, args.repeat, args.html_words)
+    out = out or os.path.join(here, 'results', '%s-%d.json' % (report['commit'], args.items))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=1)
+    for name, stats in report['results'].items():
+        print('%-28s p50 %9.2fms  p95 %9.2fms  n %d' % (name, stats['p50_ms'], stats['p95_ms'], stats['n']))
+    print('db %.1f MB, %d server requests, %.0f bytes per item list row, results in %s' %
+          (report['db_bytes'] / 1e6, report['server_requests'], report['item_list_bytes_per_row'], out))
+    for view, group, feed, sort_by, detail in report['query_plan_scans']:
+        print('full scan: %s group %s feed %s by %s: %s' % (view, group, feed, sort_by, detail))
+    if report['query_plan_scans']:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
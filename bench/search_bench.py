@@ -0,0 +1,108 @@
+# coding: utf-8
+
+'''
+Search latency benchmark for Feverista°
+
+Builds a throwaway database with synthetic items, then times searchItems for
+a handful of queries and scopes. Only the headless core is imported, so it
+runs anywhere requests is installed:
+
+    python bench/search_bench.py [items]
+'''
+
+import importlib
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+syllables = ('ba', 'ke', 'lo', 'mi', 'nu', 'ra', 'si', 'to', 'vel', 'zor', 'qua', 'den', 'fi', 'gar', 'hum', 'jo')
+
+
+def vocabulary(size=20000):
+    # made up words with a zipf-like frequency so some terms are common and most are rare
+    rnd = random.Random(7)
+    vocab = []
+    seen = set()
+    while len(vocab) < size:
+        word = ''.join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            vocab.append(word)
+    weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(size)))
+    return vocab, weights
+
+
+def loadApp():
+    import feverista_core
+    # a fresh module state each time, the benchmarks swap in their own db
+    return importlib.reload(feverista_core)
+
+
+def fillDb(app, count, vocab, weights, feeds=50, groups=5):
+    rnd = random.Random(42)
+    now = int(time.time())
+    with app.BulkWriter(app.db) as writer:
+        writer.write('groups', ((g, 'Group %d' % g) for g in range(1, groups + 1)))
+        writer.write('feeds', ((f, f, 'Feed %d' % f, '', '', 0, now) for f in range(1, feeds + 1)))
+        writer.write('feeds_group', ((f % groups + 1, f) for f in range(1, feeds + 1)))
+
+        def items():
+            for i in range(1, count + 1):
+                body = ' '.join(rnd.choices(vocab, cum_weights=weights, k=120))
+                title = ' '.join(rnd.choices(vocab, cum_weights=weights, k=6))
+                yield (i, rnd.randint(1, feeds), title, 'author%d' % (i % 40),
+                       '<p>' + body + '</p>', 'http://example.com/%d' % i,
+                       int(i % 20 == 0), int(i % 3 == 0), now - i * 30, body)
+        writer.writeItems(items())
+        app.rebuildCounts(writer)
+
+
+def timeit(fn, repeat=20):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.95) - 1]
+
+
+def main(count=100000):
+    app = loadApp()
+    path = os.path.join(tempfile.mkdtemp(), 'search_bench.db')
+    app.default_account.db = app.ConnectionManager(path)
+    app.migrateDb()
+
+    vocab, weights = vocabulary()
+    start = time.perf_counter()
+    fillDb(app, count, vocab, weights)
+    print('built %d items in %.1fs, %.1f MB' %
+          (count, time.perf_counter() - start, os.path.getsize(path) / 1e6))
+
+    common, medium, rare = vocab[3], vocab[300], vocab[8000]
+    cases = [
+        ('common word', 'Unread', common, '%', '%', 0),
+        ('medium word', 'Unread', medium, '%', '%', 0),
+        ('rare word', 'Unread', rare, '%', '%', 0),
+        ('two words', 'All Items', medium + ' ' + vocab[301], '%', '%', 0),
+        ('prefix', 'All Items', medium[:3], '%', '%', 0),
+        ('group scope', 'Unread', medium, 2, '%', 0),
+        ('feed scope', 'Archived', medium, '%', 7, 0),
+        ('deep page', 'All Items', medium, '%', '%', 20),
+    ]
+    for name, view, text, group_id, feed_id, page in cases:
+        app.view_type = view
+        p50, p95 = timeit(lambda: app.searchItems(text, group_id, feed_id, page))
+        print('%-12s %-10s %-22r p50 %7.2fms  p95 %7.2fms' %
+              (name, view, text, p50, p95))
+    app.db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
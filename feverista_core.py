@@ -0,0 +1,2900 @@
+# coding: utf-8
+
+'''
+Feverista° core: the database, Fever API sync and queries, with no
+Pythonista UI imports so it also runs headless. Feverista°.py is the app
+built on it. From a shell or a scheduler:
+
+    python feverista_core.py sync [--full] [--profile sync.prof]
+    python feverista_core.py stats [--json]
+'''
+
+import sqlite3
+import sys
+import threading
+import queue
+from contextlib import contextmanager
+from urllib.parse import quote
+import requests
+import hashlib
+import os
+import zlib
+from datetime import datetime, timedelta
+import time
+from functools import lru_cache
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import base64
+import codecs
+import cProfile
+import io
+import pstats
+import json
+import re
+import html as htmllib
+from collections import OrderedDict
+
+app_name = 'Feverista°'
+# Input the URL of your Fever API
+baseurl = ''
+# Leave blank if you don't use a text reader
+readurl = ''
+# email and password you use to login to Fever
+email = ''
+pword = ''
+api_key = hashlib.md5(str(email + ':' + pword).encode('utf-8')).hexdigest()
+payload = {'api_key': api_key}
+# more Fever accounts, each synced into its own database next to fvr_db
+# e.g. {'work': {'baseurl': '', 'email': '', 'pword': ''}}
+fever_accounts = {}
+
+# Change these options depending on the view you want. Would be better in the UI
+# Saved Archived Unread All Items
+view_type = 'Unread'
+group_by = 'date'  # date group feed
+# item_created_on_time feed_id item_created_minsago
+item_sort_by = 'item_created_on_time'
+item_sort_direction = 'ASC'  # DESC ASC
+# rows fetched per page in item lists, and how close to the end the next page loads
+item_page_size = 100
+item_page_margin = 20
+# search results per page
+search_page_size = 25
+# full text articles fetched through readurl after each sync and kept on disk
+article_cache_dir = 'article_cache'
+article_cache_bytes = 50 * 1024 * 1024
+prefetch_threads = 3
+prefetch_limit = 200
+prefetch_timeout = 30
+# images from item html downloaded after each sync, stored once per content hash
+image_cache_dir = 'image_cache'
+image_cache_bytes = 100 * 1024 * 1024
+image_threads = 4
+image_timeout = 20
+# mark calls are queued in the outbox and retried with backoff when they fail
+outbox_retry_seconds = 15
+outbox_max_retry_seconds = 30 * 60
+# background sync polls between these bounds, following how often feeds update
+sync_min_interval = 5 * 60
+sync_max_interval = 2 * 60 * 60
+sync_backoff = 1.5
+# while the server has nothing new, read and saved marks made in other
+# clients are still picked up at least this often
+sync_state_interval = 15 * 60
+# open articles from their url (through readurl if set) or from the stored html
+article_view = 'url'  # url html
+
+# what to call and where to store the database
+fvr_db = 'fvr.db'
+# pooled read-only connections and prepared statements kept per connection
+reader_pool_size = 4
+statement_cache_size = 256
+# decoded favicons kept in memory
+favicon_cache_size = 128
+
+# sync tuning: rows per executemany chunk, each chunk is committed on its own
+ingest_chunk_size = 500
+# concurrent item downloads and ids per with_ids request (the API caps this at 50)
+download_threads = 4
+with_ids_batch_size = 50
+# PRAGMAs applied for the duration of a sync and restored afterwards,
+# the journal stays in WAL so readers are not blocked by the sync
+sync_pragmas = {'synchronous': 'OFF',
+                'cache_size': -32000,
+                'temp_store': 'MEMORY'}
+# print sync statistics to the console
+verbose = False
+# sync phase and data access timings, logged to the console and/or appended
+# as JSON lines to a file, see Instruments for adding an in-app callback
+instrument_log = False
+instrument_json = None  # e.g. 'instruments.jsonl'
+# run background syncs under cProfile, the stats are dumped to this file
+profile_sync = None  # e.g. 'sync.prof'
+
+# items.html is stored zlib compressed as a BLOB and only inflated when an
+# article is opened, older TEXT rows are read as they are until migrated
+compress_html = True
+html_compress_level = 6
+html_migrate_batch = 200
+
+# how long items stay in each view, in seconds, views left out are kept.
+# Unread and saved items the server still lists come back with the next
+# sync, so Archived (read and not saved) is the one worth limiting
+retention_policies = {'Archived': 3 * 24 * 60 * 60}
+# per feed overrides, feed_id: {view_type: seconds or None to keep}
+feed_retention = {}
+# rows deleted and free pages reclaimed per write transaction
+retention_batch = 500
+vacuum_batch_pages = 256
+
+# Fever API calls: (connect, read) timeout in seconds, retries on connection
+# errors and 5xx with a doubling delay, and latency histogram bounds in ms
+api_timeout = (5, 30)
+api_retries = 2
+api_retry_delay = 0.5
+api_latency_buckets = (50, 100, 250, 500, 1000, 2500, 5000)
+# items pages are parsed as they arrive instead of loading the whole body,
+# at most stream_queue_size parsed items wait between downloads and the db
+stream_items = True
+stream_chunk_size = 16 * 1024
+stream_queue_size = 200
+# article prefetch and image caching carry on in the background after a sync,
+# the command line waits for them
+background_fetch = True
+
+tag_pattern = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.S | re.I)
+
+
+class Instruments(object):
+    '''
+    Times named phases and data access calls, recording wall time, time
+    spent in sqlite on the calling thread, rows touched and bytes downloaded,
+    and hands each record to the sinks. Sinks are callables taking the
+    record dict, nothing is measured while there are none.
+    '''
+
+    def __init__(self):
+        self.sinks = []
+        self.local = threading.local()
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def removeSink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+    def sqlSecs(self):
+        return getattr(self.local, 'sql_secs', 0.0)
+
+    def addSql(self, secs):
+        self.local.sql_secs = self.sqlSecs() + secs
+
+    @contextmanager
+    def phase(self, name, kind='phase'):
+        '''
+        The body can set record['rows'], otherwise rows changed through the
+        writer connection are counted
+        '''
+        record = {'name': name, 'kind': kind}
+        if not self.sinks:
+            yield record
+            return
+        changes = db.writer_conn.total_changes if db.writer_conn else 0
+        downloaded = fever.totalBytes()
+        sql = self.sqlSecs()
+        start = time.perf_counter()
+        record['start'] = time.time()
+        try:
+            yield record
+        finally:
+            record['wall_ms'] = (time.perf_counter() - start) * 1000
+            record['sql_ms'] = (self.sqlSecs() - sql) * 1000
+            record['bytes'] = fever.totalBytes() - downloaded
+            if 'rows' not in record:
+                record['rows'] = (db.writer_conn.total_changes if db.writer_conn else 0) - changes
+            record['thread'] = threading.current_thread().name
+            self.emit(record)
+
+    def emit(self, record):
+        for sink in list(self.sinks):
+            try:
+                sink(record)
+            except Exception as e:
+                # a broken sink must not break a sync
+                print('instrument sink failed: %s' % e)
+
+    def steps(self, name):
+        return PhaseSteps(self, name)
+
+
+class PhaseSteps(object):
+    '''
+    Consecutive phases of one run, each step ends the one before it
+    '''
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+        self.current = None
+        self.label = None
+
+    def step(self, label):
+        self.finish()
+        self.label = label
+        self.current = self.instruments.phase(self.name + ': ' + label)
+        self.current.__enter__()
+
+    def finish(self):
+        if self.current is not None:
+            current, self.current = self.current, None
+            current.__exit__(None, None, None)
+
+
+def logSink(record):
+    print('%-40s %9.1fms  sql %8.1fms  %7d rows  %9d bytes' % (
+        record['name'], record['wall_ms'], record['sql_ms'], record['rows'], record['bytes']))
+
+
+class JsonFileSink(object):
+    '''
+    Appends each record as a line of JSON
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+instruments = Instruments()
+if instrument_log:
+    instruments.addSink(logSink)
+if instrument_json:
+    instruments.addSink(JsonFileSink(instrument_json))
+
+
+def resultRows(result):
+    # rows in what a data access call returns, writes return the rows changed
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    if isinstance(result, (str, bytes)):
+        return 1 if result else 0
+    return len(result) if hasattr(result, '__len__') else 0
+
+
+def instrumented(fn):
+    # records a data access call, rows is the length of what it returns, the
+    # writer's total_changes is never used as it counts a concurrent sync too
+    def wrapper(*args, **kwargs):
+        if not instruments.sinks:
+            return fn(*args, **kwargs)
+        with instruments.phase(fn.__name__, 'call') as record:
+            record['rows'] = 0
+            result = fn(*args, **kwargs)
+            record['rows'] = resultRows(result)
+            return result
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+
+class TimedCursor(sqlite3.Cursor):
+    # the time to step a statement's first row, later rows are read on fetch
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            instruments.addSql(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            instruments.addSql(time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    '''
+    Connection factory adding the time spent in sqlite to Instruments
+    '''
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            instruments.addSql(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            instruments.addSql(time.perf_counter() - start)
+
+
+def packHtml(html):
+    if not compress_html or not html:
+        return html
+    packed = zlib.compress(html.encode('utf-8'), html_compress_level)
+    # short bodies can come out larger, those stay as text
+    return packed if len(packed) < len(html) else html
+
+
+def unpackHtml(html):
+    if isinstance(html, bytes):
+        return zlib.decompress(html).decode('utf-8')
+    return html or ''
+
+
+def stripHtml(html):
+    if not html:
+        return ''
+    return htmllib.unescape(tag_pattern.sub(' ', unpackHtml(html)))
+
+
+current = threading.local()
+
+
+def currentAccount():
+    return getattr(current, 'account', None) or default_account
+
+
+@contextmanager
+def using(account):
+    '''
+    Runs the body against account: db, fever, outbox and the caches below
+    resolve to its own instances on this thread
+    '''
+    previous = getattr(current, 'account', None)
+    current.account = account
+    try:
+        yield account
+    finally:
+        current.account = previous
+
+
+def inAccount(fn):
+    # threads start without an account, carry over the one fn was handed out in
+    account = currentAccount()
+
+    def run(*args, **kwargs):
+        with using(account):
+            return fn(*args, **kwargs)
+    return run
+
+
+class AccountProxy(object):
+    '''
+    Stands in for a per-account module global such as db, forwarding to
+    the current account's instance
+    '''
+
+    def __init__(self, attr):
+        object.__setattr__(self, 'attr', attr)
+
+    def __getattr__(self, name):
+        return getattr(getattr(currentAccount(), self.attr), name)
+
+    def __setattr__(self, name, value):
+        setattr(getattr(currentAccount(), self.attr), name, value)
+
+
+class ConnectionManager(object):
+    '''
+    Hands out one shared WAL-mode writer connection, serialised by write_lock,
+    and a pool of read-only reader connections. Each connection keeps its own
+    prepared statement cache.
+    '''
+
+    def __init__(self, path, readers=None):
+        self.path = path
+        self.max_readers = readers or reader_pool_size
+        self.write_lock = threading.RLock()
+        self.writer_conn = None
+        self.readers = queue.LifoQueue()
+
+    def connect(self, readonly=False):
+        if readonly:
+            conn = sqlite3.connect('file:' + quote(self.path) + '?mode=ro', uri=True, factory=TimedConnection,
+                                   check_same_thread=False, cached_statements=statement_cache_size)
+            conn.row_factory = sqlite3.Row
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection,
+                                   cached_statements=statement_cache_size, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def writerConnection(self):
+        with self.write_lock:
+            if self.writer_conn is None:
+                self.writer_conn = self.connect()
+            return self.writer_conn
+
+    @contextmanager
+    def writer(self):
+        # the writer runs in autocommit mode, callers BEGIN/COMMIT explicitly
+        with self.write_lock:
+            yield self.writerConnection()
+
+    @contextmanager
+    def reader(self):
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = self.connect(readonly=True)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self.readers.qsize() < self.max_readers:
+                self.readers.put(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        with self.write_lock:
+            if self.writer_conn is not None:
+                self.writer_conn.close()
+                self.writer_conn = None
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+
+db = ConnectionManager(fvr_db)
+
+
+def createDb():
+    with db.writer() as conn:
+        # freed pages are returned by reclaimSpace. The mode only takes hold
+        # after a VACUUM, which is instant on a new database, older ones are
+        # switched in the background by switchAutoVacuum
+        if conn.execute('SELECT count(*) FROM sqlite_master').fetchone()[0] == 0:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS groups
+               (id INTEGER PRIMARY KEY NOT NULL,
+               title TEXT NOT NULL);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS feeds
+            (id INTEGER PRIMARY KEY NOT NULL,
+            favicon_id INTEGER NOT NULL,
+            title TEXT,
+            url TEXT,
+            site_url TEXT,
+            is_spark INTEGER NOT NULL,
+            last_updated_on_time TIMESTAMP);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS feeds_group
+            (group_id INTEGER NOT NULL,
+            feed_id INTEGER NOT NULL);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS favicons
+            (id INTEGER PRIMARY KEY NOT NULL,
+            data TEXT NOT NULL);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS items
+            (id INTEGER PRIMARY KEY NOT NULL,
+            feed_id INTEGER,
+            title TEXT,
+            author TEXT,
+            html TEXT,
+            url TEXT,
+            is_saved INTEGER,
+            is_read INTEGER,
+            created_on_time TIMESTAMP);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS links
+            (id INTEGER PRIMARY KEY NOT NULL,
+            feed_id INTEGER,
+            item_id INTEGER,
+            temperature NUMERIC,
+            is_item NUMERIC,
+            is_local NUMERIC,
+            is_saved NUMERIC,
+            title TEXT,
+            url TEXT,
+            item_ids TEXT);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS last_refreshed_on_time
+            (last_refreshed_on_time TIMESTAMP);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS images
+            (url TEXT PRIMARY KEY NOT NULL,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used INTEGER NOT NULL);''')
+
+        conn.execute('''CREATE INDEX IF NOT EXISTS "idxImagesHash" ON "images" (
+        	"hash"
+        )''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS outbox
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mark TEXT NOT NULL,
+            as_state TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            before INTEGER,
+            created INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL DEFAULT 0);''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS row_hashes
+            (table_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (table_name, row_key)) WITHOUT ROWID;''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS counts
+            (view_type TEXT NOT NULL,
+            group_id INTEGER NOT NULL,
+            feed_id INTEGER NOT NULL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (view_type, group_id, feed_id)) WITHOUT ROWID;''')
+
+        conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS "idxItemId" ON "items" (
+        	"id"	ASC
+        )''')
+
+        conn.execute('''CREATE INDEX IF NOT EXISTS "idxLinksId" ON "links" (
+        	"id"	ASC
+        )''')
+
+        # state columns first so every view filter can seek it, see view_filters
+        conn.execute('''CREATE INDEX IF NOT EXISTS "idxItemsState" ON "items" (
+        	"is_read", "is_saved", "feed_id", "created_on_time"
+        )''')
+
+        # retention range deletes, see purgeItems
+        conn.execute('''CREATE INDEX IF NOT EXISTS "idxItemsAge" ON "items" (
+        	"is_read", "is_saved", "created_on_time"
+        )''')
+
+        conn.execute('''CREATE INDEX IF NOT EXISTS "idxFeedsGroup" ON "feeds_group" (
+        	"feed_id", "group_id"
+        )''')
+
+        createCountTriggers(conn)
+        if conn.execute('SELECT count(*) FROM counts').fetchone()[0] == 0:
+            conn.execute('BEGIN')
+            rebuildCounts(conn)
+            conn.execute('COMMIT')
+
+
+# which views an item row belongs to, {row} is NEW or OLD inside a trigger
+count_views_sql = '''
+    SELECT 'Saved' AS view_type WHERE {row}.is_saved = 1
+    UNION ALL SELECT 'Unread' WHERE {row}.is_read = 0 AND (SELECT is_spark FROM feeds WHERE id = {row}.feed_id) = 0
+    UNION ALL SELECT 'All Items' WHERE {row}.is_saved = 1 OR (SELECT is_spark FROM feeds WHERE id = {row}.feed_id) = 0
+    UNION ALL SELECT 'Archived' WHERE {row}.is_read = 1 AND {row}.is_saved = 0'''
+
+# the groups an item row is counted under, 0 when its feed has no group
+count_groups_sql = '''
+    SELECT group_id FROM feeds_group WHERE feed_id = {row}.feed_id
+    UNION SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM feeds_group WHERE feed_id = {row}.feed_id)'''
+
+count_upsert_sql = '''
+    INSERT INTO counts (view_type, group_id, feed_id, item_count)
+    SELECT v.view_type, g.group_id, coalesce({row}.feed_id, 0), {sign}1
+    FROM (''' + count_views_sql + ''') v, (''' + count_groups_sql + ''') g
+    WHERE true
+    ON CONFLICT (view_type, group_id, feed_id) DO UPDATE SET item_count = item_count {sign} 1;'''
+
+
+def createCountTriggers(conn):
+    add = count_upsert_sql.format(row='NEW', sign='+')
+    remove = count_upsert_sql.format(row='OLD', sign='-')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS trgCountsInsert AFTER INSERT ON items BEGIN ' +
+                 add + ' END;')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS trgCountsDelete AFTER DELETE ON items BEGIN ' +
+                 remove + ' END;')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trgCountsUpdate AFTER UPDATE OF is_read, is_saved, feed_id ON items
+        WHEN OLD.is_read IS NOT NEW.is_read OR OLD.is_saved IS NOT NEW.is_saved OR OLD.feed_id IS NOT NEW.feed_id
+        BEGIN ''' + remove + add + ' END;')
+
+
+def rebuildCounts(conn):
+    # full recount, needed when feeds or their groups change underneath the items
+    conn.execute('DELETE FROM counts')
+    conn.execute('''INSERT INTO counts (view_type, group_id, feed_id, item_count)
+        SELECT v.view_type, coalesce(feeds_group.group_id, 0), coalesce(items.feed_id, 0), count(*)
+        FROM items
+        LEFT OUTER JOIN feeds
+        ON items.feed_id = feeds.id
+        LEFT OUTER JOIN feeds_group
+        ON items.feed_id = feeds_group.feed_id
+        JOIN (SELECT 'Saved' AS view_type UNION ALL SELECT 'Unread' UNION ALL SELECT 'All Items' UNION ALL SELECT 'Archived') v
+        ON (v.view_type = 'Saved' AND items.is_saved = 1)
+        OR (v.view_type = 'Unread' AND items.is_read = 0 AND feeds.is_spark = 0)
+        OR (v.view_type = 'All Items' AND (items.is_saved = 1 OR feeds.is_spark = 0))
+        OR (v.view_type = 'Archived' AND items.is_read = 1 AND items.is_saved = 0)
+        GROUP BY 1, 2, 3''')
+
+
+def countTotal(conn, view_type):
+    # a feed appears once per group in counts, so take one row per feed
+    row = conn.execute('''SELECT coalesce(sum(item_count), 0) FROM
+        (SELECT feed_id, max(item_count) AS item_count FROM counts
+        WHERE view_type = ? GROUP BY feed_id)''', (view_type,)).fetchone()
+    return row[0]
+
+
+def dropLegacyViews():
+    # the window function views the item lists read before buildItemQuery
+    with db.writer() as conn:
+        for view in ('vwSaved', 'vwUnread', 'vwAllItems', 'vwArchive', 'vwFever', 'vwFever2'):
+            conn.execute('DROP VIEW IF EXISTS `%s`' % view)
+
+
+def moveSearchText():
+    '''
+    Replaces the search index that read its text through vwItemsText and
+    the strip_html function with one that stores its own text, or creates
+    it on a new database. The old items are indexed again by indexItems.
+    '''
+    with db.writer() as conn:
+        conn.execute('BEGIN')
+        for trigger in ('trgSearchInsert', 'trgSearchDelete', 'trgSearchUpdate'):
+            conn.execute('DROP TRIGGER IF EXISTS ' + trigger)
+        conn.execute('DROP TABLE IF EXISTS items_fts')
+        conn.execute('DROP VIEW IF EXISTS vwItemsText')
+        try:
+            conn.execute('''CREATE VIRTUAL TABLE items_fts USING fts5
+                (title, author, body, tokenize='porter unicode61')''')
+        except sqlite3.OperationalError:
+            # no fts5 in this sqlite, search stays off
+            pass
+        else:
+            conn.execute('''CREATE TRIGGER trgSearchDelete AFTER DELETE ON items BEGIN
+                DELETE FROM items_fts WHERE rowid = OLD.id; END;''')
+            conn.execute('''CREATE TRIGGER trgSearchUpdate AFTER UPDATE OF title, author ON items BEGIN
+                UPDATE items_fts SET title = NEW.title, author = NEW.author WHERE rowid = NEW.id; END;''')
+        conn.execute('COMMIT')
+
+
+def contentlessSearch():
+    '''
+    Replaces the search index that stores its own copy of the text with a
+    contentless one holding only the index. Rows can't be deleted from it by
+    rowid, only by handing back the text they were indexed with, so the
+    triggers go and purgeItems drops the entries itself, see unindexItems.
+    Items rows are never edited after the insert, so that text is always
+    there to strip again. The items are indexed again by indexItems.
+    '''
+    with db.writer() as conn:
+        conn.execute('BEGIN')
+        for trigger in ('trgSearchDelete', 'trgSearchUpdate'):
+            conn.execute('DROP TRIGGER IF EXISTS ' + trigger)
+        conn.execute('DROP TABLE IF EXISTS items_fts')
+        try:
+            conn.execute('''CREATE VIRTUAL TABLE items_fts USING fts5
+                (title, author, body, content='', tokenize='porter unicode61')''')
+        except sqlite3.OperationalError:
+            # no fts5 in this sqlite, search stays off
+            pass
+        conn.execute("DELETE FROM background_migrations WHERE name = 'search_index'")
+        conn.execute('COMMIT')
+
+
+# an item stored and not yet in the search index
+unindexed_sql = 'SELECT 1 FROM items WHERE id = ? AND NOT EXISTS (SELECT 1 FROM items_fts WHERE rowid = ?)'
+
+
+def indexItems():
+    '''
+    Adds the items missing from the search index, a batch per transaction
+    '''
+    last_id = -1
+    while True:
+        with db.reader() as conn:
+            if not searchAvailable(conn):
+                return True
+            rows = conn.execute('''SELECT id, title, author, html FROM items WHERE id > ?
+                AND NOT EXISTS (SELECT 1 FROM items_fts WHERE rowid = items.id) ORDER BY id LIMIT ?''',
+                                (last_id, html_migrate_batch)).fetchall()
+        if not rows:
+            return True
+        last_id = rows[-1][0]
+        entries = [(item_id, title, author, stripHtml(html)) for item_id, title, author, html in rows]
+        with db.writer() as conn:
+            conn.execute('BEGIN')
+            # a sync or a purge may have got to some of them since the read
+            entries = [entry for entry in entries
+                       if conn.execute(unindexed_sql, (entry[0], entry[0])).fetchone()]
+            conn.executemany('INSERT INTO items_fts (rowid, title, author, body) VALUES (?,?,?,?)',
+                             entries)
+            conn.execute('COMMIT')
+
+
+def unindexItems(conn, ids):
+    '''
+    Drops items from the search index ahead of deleting them, inside the
+    caller's transaction. The contentless index needs the text each one was
+    indexed with, which is stripped again from the stored html.
+    '''
+    if not searchAvailable(conn):
+        return
+    entries = []
+    for item_id in ids:
+        row = conn.execute('''SELECT title, author, html FROM items WHERE id = ?
+            AND EXISTS (SELECT 1 FROM items_fts WHERE rowid = ?)''', (item_id, item_id)).fetchone()
+        if row:
+            entries.append((item_id, row[0], row[1], stripHtml(row[2])))
+    conn.executemany('''INSERT INTO items_fts (items_fts, rowid, title, author, body)
+        VALUES ('delete', ?, ?, ?, ?)''', entries)
+
+
+def createMigrationsTable():
+    with db.writer() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS background_migrations
+            (name TEXT PRIMARY KEY NOT NULL,
+            finished INTEGER NOT NULL);''')
+
+
+def switchAutoVacuum():
+    '''
+    Turns on incremental auto_vacuum for a database made before it, which
+    takes one full VACUUM. It runs after compress_html, so the space that
+    freed goes back too.
+    '''
+    with db.writer() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+    return True
+
+
+# schema steps in order, the database's PRAGMA user_version is how many of
+# them it has had. Add new steps to the end, never change one that shipped,
+# and write each one out in full rather than calling code that moves on.
+# Anything that rewrites rows belongs in background_migrations instead.
+schema_migrations = [
+    createDb,
+    # rebuilt the legacy views, dropLegacyViews now takes them out
+    lambda: None,
+    # was the html compression, now in background_migrations
+    lambda: None,
+    createMigrationsTable,
+    moveSearchText,
+    dropLegacyViews,
+    contentlessSearch,
+]
+
+# data migrations too slow for startup, run in batches once the app is up.
+# Each returns true when it has finished, which is recorded in the
+# background_migrations table so it never runs again.
+background_migrations = OrderedDict([
+    # compress article bodies stored before compress_html was on
+    ('compress_html', lambda: compress_html and migrateHtmlStorage()),
+    # search index entries for the items stored before contentlessSearch
+    ('search_index', indexItems),
+    # incremental auto_vacuum for databases made before it
+    ('auto_vacuum', switchAutoVacuum),
+])
+
+
+def migrateDb():
+    '''
+    Applies the schema steps the database has not had yet. Once it is up to
+    date this is a single PRAGMA read. Returns the version it started at.
+    '''
+    with db.writer() as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for step in range(version, len(schema_migrations)):
+            schema_migrations[step]()
+            conn.execute('PRAGMA user_version = %d' % (step + 1))
+            if verbose:
+                print('schema migrated to version %d' % (step + 1))
+    return version
+
+
+def pendingMigrations():
+    with db.reader() as conn:
+        finished = set(row[0] for row in conn.execute('SELECT name FROM background_migrations'))
+    return [name for name in background_migrations if name not in finished]
+
+
+def runBackgroundMigrations():
+    for name in pendingMigrations():
+        if background_migrations[name]():
+            with db.writer() as conn:
+                conn.execute('INSERT OR REPLACE INTO background_migrations VALUES (?, ?)',
+                             (name, int(time.time())))
+            if verbose:
+                print('background migration %s finished' % name)
+
+
+def startBackgroundMigrations():
+    '''
+    Runs the unfinished background migrations on a daemon thread and
+    returns it, or None when there is nothing left to do
+    '''
+    if not pendingMigrations():
+        return None
+    thread = threading.Thread(target=inAccount(runBackgroundMigrations), daemon=True)
+    thread.start()
+    return thread
+
+
+insert_sql = {
+    'items': 'insert or ignore into items values (?,?,?,?,?,?,?,?,?)',
+    'groups': 'insert into groups values (?,?)',
+    'feeds': 'insert into feeds values (?,?,?,?,?,?,?)',
+    'feeds_group': 'insert into feeds_group values (?,?)',
+    'favicons': 'insert into favicons values (?,?)',
+    'links': 'insert into links values (?,?,?,?,?,?,?,?,?,?)',
+    'last_refreshed_on_time': 'insert into last_refreshed_on_time values (?)'
+}
+
+# key columns (leading columns of each row) for tables synced by diff
+diff_keys = {
+    'groups': ('id',),
+    'feeds': ('id',),
+    'feeds_group': ('group_id', 'feed_id'),
+    'favicons': ('id',),
+    'links': ('id',)
+}
+
+
+class BulkWriter(object):
+    '''
+    Streams rows into the database with executemany, reusing one prepared
+    statement per table and committing every chunk. The write lock is only
+    held while a transaction is open, and a transaction never waits on the
+    rows being produced, so other writers get a turn while a sync downloads.
+    Keeps a rows/seconds tally per table for reporting.
+    '''
+
+    def __init__(self, db, chunk_size=None):
+        self.conn = db.writerConnection()
+        self.lock = db.write_lock
+        self.chunk_size = chunk_size or ingest_chunk_size
+        self.stats = {}
+        self.changes = {}
+        self.flipped = {}
+        self.saved_pragmas = {}
+        self.in_txn = False
+        self.search = searchAvailable(self.conn)
+
+    def __enter__(self):
+        with self.lock:
+            for pragma, value in sync_pragmas.items():
+                self.saved_pragmas[pragma] = self.conn.execute(
+                    'PRAGMA ' + pragma).fetchone()[0]
+                self.conn.execute('PRAGMA %s = %s' % (pragma, value))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.lock:
+            for pragma, value in self.saved_pragmas.items():
+                self.conn.execute('PRAGMA %s = %s' % (pragma, value))
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Holds the write lock with a transaction open for the body, which
+        should only do local work. Nested uses join the outer transaction.
+        '''
+        if self.in_txn:
+            yield self.conn
+            return
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.in_txn = True
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+            finally:
+                self.in_txn = False
+
+    def execute(self, sql, params=()):
+        with self.transaction():
+            return self.conn.execute(sql, params)
+
+    def write(self, table, rows, sql=None, flush=None):
+        sql = sql or insert_sql[table]
+        flush = flush or self._flush
+        start = time.perf_counter()
+        count = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                count += flush(sql, chunk)
+                chunk = []
+        if chunk:
+            count += flush(sql, chunk)
+        rows_done, secs = self.stats.get(table, (0, 0.0))
+        self.stats[table] = (rows_done + count,
+                             secs + time.perf_counter() - start)
+        return count
+
+    def sync(self, table, rows):
+        '''
+        Diffs incoming rows against the stored content hashes and only writes
+        the rows that were added, changed or removed. Returns the changed keys.
+        '''
+        keys = diff_keys[table]
+        # the rows are already downloaded, so the table is diffed in one transaction
+        with self.transaction():
+            stored = dict(self.execute(
+                'SELECT row_key, hash FROM row_hashes WHERE table_name = ?', (table,)))
+            if not stored:
+                # nothing recorded yet, so rewrite the table once
+                self.execute('DELETE FROM ' + table)
+
+            incoming = {}
+            upserts = []
+            inserted = 0
+            for row in rows:
+                row = tuple(row)
+                key = ':'.join(str(k) for k in row[:len(keys)])
+                digest = hashlib.sha1(repr(row).encode('utf-8')).hexdigest()
+                incoming[key] = digest
+                if stored.get(key) != digest:
+                    upserts.append(row)
+                    inserted += key not in stored
+            deleted = [key for key in stored if key not in incoming]
+            changed = [key for key in incoming if stored.get(key) != incoming[key]]
+
+            self.write(table, upserts,
+                       insert_sql[table].replace('insert into', 'insert or replace into'))
+            self.write(table, (key.split(':') for key in deleted),
+                       'DELETE FROM ' + table + ' WHERE ' + ' AND '.join(k + ' = ?' for k in keys))
+            self.write('row_hashes', ((table, key, incoming[key]) for key in changed),
+                       'insert or replace into row_hashes values (?,?,?)')
+            self.write('row_hashes', ((table, key) for key in deleted),
+                       'DELETE FROM row_hashes WHERE table_name = ? AND row_key = ?')
+
+        self.changes[table] = {'inserted': inserted,
+                               'updated': len(upserts) - inserted,
+                               'deleted': len(deleted)}
+        return set(changed) | set(deleted)
+
+    def loadIds(self, name, ids):
+        # id sets live in indexed temp tables so reconcile can join against them
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS ' + name +
+                     ' (id INTEGER PRIMARY KEY)')
+        with self.transaction():
+            self.execute('DELETE FROM temp.' + name)
+            self.write(name, ((i,) for i in ids),
+                       'insert or ignore into temp.' + name + ' values (?)')
+
+    def reconcile(self):
+        '''
+        Flips is_read/is_saved only on rows whose state differs from the
+        unread_ids/saved_ids temp tables and records how many changed
+        '''
+        statements = [
+            ('read', '''UPDATE items SET is_read = 1 WHERE is_read = 0
+                AND NOT EXISTS (SELECT 1 FROM temp.unread_ids u WHERE u.id = items.id)'''),
+            ('unread', '''UPDATE items SET is_read = 0 WHERE is_read = 1
+                AND id IN (SELECT id FROM temp.unread_ids)'''),
+            ('saved', '''UPDATE items SET is_saved = 1 WHERE is_saved = 0
+                AND id IN (SELECT id FROM temp.saved_ids)'''),
+            ('unsaved', '''UPDATE items SET is_saved = 0 WHERE is_saved = 1
+                AND NOT EXISTS (SELECT 1 FROM temp.saved_ids s WHERE s.id = items.id)''')
+        ]
+        with self.transaction():
+            for state, sql in statements:
+                self.flipped[state] = self.execute(sql).rowcount
+        return self.flipped
+
+    def writeItems(self, rows):
+        '''
+        Rows are the items columns followed by the html-stripped body, which
+        goes to the search index in the same transaction as its item
+        '''
+        return self.write('items', rows, flush=self._flushItems)
+
+    def _flushItems(self, sql, chunk):
+        with self.transaction():
+            if self.search:
+                # the insert ignores items already stored, so the index must too
+                fresh = OrderedDict()
+                for row in chunk:
+                    if row[0] not in fresh and self.conn.execute(
+                            'SELECT 1 FROM items WHERE id = ?', (row[0],)).fetchone() is None:
+                        fresh[row[0]] = row
+            self.conn.executemany(sql, (row[:-1] for row in chunk))
+            if self.search:
+                self.conn.executemany('INSERT INTO items_fts (rowid, title, author, body) VALUES (?,?,?,?)',
+                                      ((row[0], row[2], row[3], row[-1]) for row in fresh.values()))
+        return len(chunk)
+
+    def _flush(self, sql, chunk):
+        # the chunk is already in memory, so the lock is not held for any download
+        with self.transaction():
+            self.conn.executemany(sql, chunk)
+        return len(chunk)
+
+    def report(self):
+        lines = []
+        for table, (rows, secs) in self.stats.items():
+            rate = rows / secs if secs > 0 else 0
+            lines.append('%s: %d rows in %.3fs (%.0f rows/s)' %
+                         (table, rows, secs, rate))
+        for table, change in self.changes.items():
+            lines.append('%s: %d inserted, %d updated, %d deleted' %
+                         (table, change['inserted'], change['updated'], change['deleted']))
+        if self.flipped:
+            lines.append('items: ' + ', '.join('%d marked %s' % (count, state)
+                                               for state, count in self.flipped.items()))
+        return lines
+
+
+class JsonStream(object):
+    '''
+    Pulls JSON values one at a time out of an iterable of byte chunks, the
+    buffer only holds the value being parsed and whatever is left of the
+    last chunk
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.done = False
+
+    def fill(self):
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+        self.buf += self.utf8.decode(b'', final=True)
+        self.done = True
+        return False
+
+    def peek(self):
+        '''
+        The next character that is not whitespace, '' at the end
+        '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected %r in JSON stream' % char)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number running into the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.done:
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.done:
+                    raise
+            self.fill()
+
+    def iterArray(self, key):
+        '''
+        Yields the elements of the array under key in the top level object,
+        the other members are parsed and dropped. Raises KeyError, like the
+        decoded dict would, if the object has no such member, such as a
+        response with auth 0.
+        '''
+        found = False
+        self.expect('{')
+        while self.peek() != '}':
+            if self.peek() == '':
+                raise ValueError('JSON stream ended inside the object')
+            name = self.value()
+            self.expect(':')
+            if name == key:
+                found = True
+                self.expect('[')
+                while self.peek() != ']':
+                    yield self.value()
+                    if self.peek() == ',':
+                        self.pos += 1
+                self.pos += 1
+            else:
+                self.value()
+            if self.peek() == ',':
+                self.pos += 1
+        if not found:
+            raise KeyError(key)
+
+
+class FeverClient(object):
+    '''
+    All calls to the Fever API go through here: one keep-alive session with
+    a connection pool sized for the download threads, gzip, timeouts and
+    retries, plus counts, bytes and latency per section
+    '''
+
+    def __init__(self, url=None, key_payload=None, pool_size=None, timeout=None, retries=None):
+        # url and key_payload default to baseurl and payload
+        self.url = url
+        self.key_payload = key_payload
+        self.pool_size = pool_size or download_threads
+        self.timeout = timeout or api_timeout
+        self.retries = api_retries if retries is None else retries
+        self.session = None
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def httpSession(self):
+        with self.lock:
+            if self.session is None:
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self.session = session
+            return self.session
+
+    def record(self, name, secs, size=0, error=False, retry=False):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'secs': 0.0,
+                                           'latency': [0] * (len(api_latency_buckets) + 1)}
+            stat['requests'] += 1
+            stat['errors'] += error
+            stat['retries'] += retry
+            stat['bytes'] += size
+            stat['secs'] += secs
+            ms = secs * 1000
+            stat['latency'][sum(1 for bound in api_latency_buckets if ms > bound)] += 1
+
+    def post(self, sections='', data=None):
+        '''
+        Posts the api key plus data to baseurl + sections and returns the
+        decoded json, sections is the query string tail like '&items&since_id=5'
+        '''
+        name, start, r = self.request(sections, data)
+        result = r.json()
+        # Content-Length is what came over the wire, before gzip is undone
+        size = int(r.headers.get('Content-Length') or len(r.content))
+        self.record(name, time.perf_counter() - start, size)
+        return result
+
+    def items(self, sections):
+        '''
+        Yields the items of an items page, parsed as the body streams in
+        unless stream_items is off
+        '''
+        if not stream_items:
+            yield from self.post(sections)['items']
+            return
+        name, start, r = self.request(sections, stream=True)
+        received = [0]
+
+        def chunks():
+            for chunk in r.iter_content(chunk_size=stream_chunk_size):
+                received[0] += len(chunk)
+                yield chunk
+        try:
+            yield from JsonStream(chunks()).iterArray('items')
+        finally:
+            r.close()
+            size = int(r.headers.get('Content-Length') or received[0])
+            self.record(name, time.perf_counter() - start, size)
+
+    def request(self, sections='', data=None, stream=False):
+        '''
+        Sends the post with retries, returns the section name used for the
+        stats, the start time and the response
+        '''
+        name = sections.lstrip('&').split('&')[0].split('=')[0] or \
+            ('mark' if data and 'mark' in data else 'bare')
+        body = dict(self.key_payload or payload)
+        if data:
+            body.update(data)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            last_try = attempt == self.retries
+            try:
+                r = self.httpSession().post((self.url or baseurl) + sections, body, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(name, time.perf_counter() - start, error=True, retry=not last_try)
+                if last_try:
+                    raise
+            else:
+                if r.status_code < 400:
+                    return name, start, r
+                # server trouble and rate limits can clear up, any other 4xx won't
+                retry = not last_try and (r.status_code >= 500 or r.status_code == 429)
+                self.record(name, time.perf_counter() - start, error=True, retry=retry)
+                if not retry:
+                    r.raise_for_status()
+                r.close()
+            time.sleep(api_retry_delay * 2 ** attempt)
+
+    def totalBytes(self):
+        with self.lock:
+            return sum(stat['bytes'] for stat in self.stats.values())
+
+    def report(self):
+        lines = []
+        labels = ['<=%dms' % bound for bound in api_latency_buckets] + \
+            ['>%dms' % api_latency_buckets[-1]]
+        for name, stat in sorted(self.stats.items()):
+            histogram = ' '.join('%s:%d' % (label, count)
+                                 for label, count in zip(labels, stat['latency']) if count)
+            lines.append('%-16s %5d calls %3d errors %3d retries %9d bytes %7.2fs  %s' % (
+                name, stat['requests'], stat['errors'], stat['retries'], stat['bytes'], stat['secs'], histogram))
+        return lines
+
+
+fever = FeverClient()
+
+
+def itemRows(items, ingested=None):
+    for data in items:
+        if ingested is not None:
+            ingested.append(data['id'])
+        yield (data['id'], data['feed_id'], data['title'], data['author'], packHtml(data['html']),
+               data['url'], data['is_saved'], data['is_read'], data['created_on_time'], stripHtml(data['html']))
+
+
+def feedsGroupRows(feeds_groups):
+    for data in feeds_groups:
+        for feed_id in data['feed_ids'].split(','):
+            yield (data['group_id'], feed_id)
+
+
+def parseIds(id_string):
+    return [int(i) for i in str(id_string or '').split(',') if i.strip()]
+
+
+def planDownloads(conn, unread_ids, saved_ids, since_id=None):
+    '''
+    Compares the unread/saved ids from the server with the local items table
+    and returns the missing ids split into with_ids sized batches, only the
+    gaps up to since_id when given, newer ids are left to since_id paging
+    '''
+    wanted = set(unread_ids) | set(saved_ids)
+    if since_id is not None:
+        wanted = set(i for i in wanted if i <= since_id)
+    local = set(row[0] for row in conn.execute('SELECT id FROM items'))
+    missing = sorted(wanted - local)
+    return [missing[i:i + with_ids_batch_size]
+            for i in range(0, len(missing), with_ids_batch_size)]
+
+
+def fetchItems(ids):
+    return fever.items('&items&with_ids=' + ','.join(str(i) for i in ids))
+
+
+def downloadItems(writer, batches, ingested=None):
+    # fetch concurrently, the calling thread is the only one writing to the db
+    if not batches:
+        return 0
+    parsed = queue.Queue(maxsize=stream_queue_size)
+    cancelled = threading.Event()
+    done = object()
+
+    def download(batch):
+        try:
+            for item in fetchItems(batch):
+                if cancelled.is_set():
+                    break
+                parsed.put(item)
+        except Exception as e:
+            parsed.put(e)
+        finally:
+            parsed.put(done)
+
+    def ingest():
+        count = 0
+        arrived = []
+        remaining = len(batches)
+        while remaining:
+            try:
+                item = parsed.get_nowait()
+            except queue.Empty:
+                # commit what has arrived before waiting on the network
+                if arrived:
+                    count += writer.writeItems(itemRows(arrived, ingested))
+                    arrived = []
+                item = parsed.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                arrived.append(item)
+        if arrived:
+            count += writer.writeItems(itemRows(arrived, ingested))
+        return count
+
+    with ThreadPoolExecutor(max_workers=download_threads) as pool:
+        futures = [pool.submit(inAccount(download), batch) for batch in batches]
+        try:
+            return ingest()
+        except BaseException:
+            # keep draining so downloads blocked on a full queue can finish
+            cancelled.set()
+            while not all(future.done() for future in futures):
+                try:
+                    parsed.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+
+
+def retentionRules():
+    '''
+    (view_type, feed_id, max age) for every policy, feed_id is None for the
+    view wide rule, which skips the feeds that have their own
+    '''
+    rules = []
+    for view_type, max_age in retention_policies.items():
+        if max_age is not None:
+            rules.append((view_type, None, max_age))
+    for feed_id, policies in feed_retention.items():
+        for view_type, max_age in policies.items():
+            if max_age is not None:
+                rules.append((view_type, int(feed_id), max_age))
+    return rules
+
+
+def purgeItems(now=None):
+    '''
+    Deletes the items past their retention as range deletes on
+    created_on_time, a batch per transaction so readers and the outbox are
+    never kept waiting, then hands the freed pages back
+    '''
+    now = int(now or time.time())
+    purged = 0
+    for view_type, feed_id, max_age in retentionRules():
+        sql, params = itemFilter(view_type, '%', '%' if feed_id is None else feed_id)
+        if feed_id is None:
+            own = [int(f) for f, policies in feed_retention.items() if view_type in policies]
+            if own:
+                sql += ' AND items.feed_id NOT IN (' + ','.join('?' * len(own)) + ')'
+                params += own
+        sql = '''SELECT items.id FROM items
+            LEFT OUTER JOIN feeds ON items.feed_id = feeds.id
+            WHERE ''' + sql + ' AND items.created_on_time < ? LIMIT ?'
+        params += [now - max_age, retention_batch]
+        while True:
+            with db.writer() as conn:
+                conn.execute('BEGIN')
+                ids = [row[0] for row in conn.execute(sql, params)]
+                unindexItems(conn, ids)
+                conn.executemany('DELETE FROM items WHERE id = ?', ((i,) for i in ids))
+                conn.execute('COMMIT')
+            deleted = len(ids)
+            purged += deleted
+            if deleted < retention_batch:
+                break
+
+    if purged:
+        with db.writer() as conn:
+            if searchAvailable(conn):
+                # fold the delete markers left by the purge back into the index
+                conn.execute("INSERT INTO items_fts (items_fts, rank) VALUES ('merge', 500)")
+        reclaimSpace()
+    return purged
+
+
+def reclaimSpace():
+    '''
+    Incremental vacuum in small steps, returns the pages released
+    '''
+    released = 0
+    while True:
+        with db.writer() as conn:
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if not free:
+                break
+            # execute() steps a statement with no result columns only once,
+            # which frees a single page, executescript runs it to completion
+            conn.executescript('PRAGMA incremental_vacuum(%d)' % vacuum_batch_pages)
+            left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        released += free - left
+        if left >= free:
+            # auto_vacuum is not incremental on this database
+            break
+    return released
+
+
+def lastRefreshed(conn):
+    row = conn.execute(
+        "SELECT last_refreshed_on_time FROM last_refreshed_on_time;").fetchone()
+    return row[0] if row and row[0] else 0
+
+
+def pollServer():
+    '''
+    The bare API call, only auth and last_refreshed_on_time come back
+    '''
+    return int(fever.post()['last_refreshed_on_time'])
+
+
+def refreshAll(full=False, refreshed=None):
+    '''
+    Groups, feeds, favicons and links are only downloaded when the server
+    has refreshed since the last sync, or when full is set. refreshed is the
+    server's last_refreshed_on_time when the caller has just polled for it.
+    '''
+    progress = instruments.steps('sync')
+    progress.step('Sending marks')
+    outbox.flush()
+    progress.step('Polling server')
+    if refreshed is None and not full:
+        refreshed = pollServer()
+    with db.reader() as conn:
+        heavy = full or refreshed != lastRefreshed(conn)
+
+    progress.step('Downloading groups, feeds and ids')
+    sections = '&saved_item_ids&unread_item_ids'
+    if heavy:
+        sections += '&groups&feeds&favicons&links&offset=0&range=7'
+    r = fever.post(sections)
+    last_refreshed = r['last_refreshed_on_time']
+    unread_ids = parseIds(r['unread_item_ids'])
+    saved_ids = parseIds(r['saved_item_ids'])
+
+    progress.step('Syncing...')
+
+    with BulkWriter(db) as writer:
+        progress.step('Updating RefreshTime...')
+        with writer.transaction():
+            writer.execute("DELETE FROM last_refreshed_on_time;")
+            writer.write('last_refreshed_on_time', [(last_refreshed,)])
+
+        # save to text file if needed
+        # with open('last_refreshed.txt', 'w') as f:
+        #    f.write(last_refreshed)
+
+        changed_favicons = []
+        if heavy:
+            progress.step('Updating groups')
+            writer.sync('groups', ((data['id'], data['title'])
+                                   for data in r['groups']))
+
+            progress.step('Updating feeds')
+            writer.sync('feeds', ((data['id'], data['favicon_id'], data['title'], data['url'], data['site_url'], data['is_spark'], data['last_updated_on_time'])
+                                  for data in r['feeds']))
+
+            progress.step('Updating feeds group')
+            writer.sync('feeds_group', feedsGroupRows(r['feeds_groups']))
+
+            progress.step('Updating favicons')
+            changed_favicons = writer.sync('favicons', ((data['id'], data['data'])
+                                                        for data in r['favicons']))
+
+            progress.step('Updating links')
+            writer.sync('links', ((data['id'], data['feed_id'], data['item_id'], data['temperature'], data['is_item'], data['is_local'], data['is_saved'], data['title'], data['url'], data['item_ids'])
+                                  for data in r['links']))
+
+        progress.step('Getting items')
+        since_id = writer.execute("SELECT max(id) FROM items;").fetchone()[0]
+
+        ingested = []
+        with db.reader() as conn:
+            batches = planDownloads(conn, unread_ids, saved_ids, since_id)
+        # no transaction is open while items download, each arrival is committed
+        downloadItems(writer, batches, ingested)
+
+        # page through anything newer than we had, or newer than the gap fill on a cold db
+        if since_id is None:
+            since_id = writer.execute("SELECT max(id) FROM items;").fetchone()[0]
+
+        checkItemArray = [1]
+        while len(checkItemArray) != 0:
+            # print("since_id: " + str(since_id))
+            checkItemArray = []
+            writer.writeItems(itemRows(fever.items('&items&since_id=' + str(since_id)), checkItemArray))
+            ingested.extend(checkItemArray)
+            if checkItemArray:
+                since_id = max(checkItemArray)
+
+        progress.step('Updating unread items')
+        # one transaction, so a mark made in the app can't land between the
+        # outbox check and the flips
+        with writer.transaction():
+            writer.loadIds('unread_ids', unread_ids)
+            writer.loadIds('saved_ids', saved_ids)
+            # reads still waiting in the outbox win over the server's unread list
+            writer.execute(outbox_pending_reads_sql)
+            writer.reconcile()
+
+        if any(sum(writer.changes.get(table, {}).values()) for table in ('feeds', 'feeds_group')):
+            progress.step('Updating counts')
+            with writer.transaction():
+                rebuildCounts(writer)
+
+    progress.step('Purging old items...')
+    purged = purgeItems()
+
+    favicon_cache.invalidate(int(key) for key in changed_favicons)
+
+    if readurl:
+        progress.step('Prefetching articles')
+        prefetchArticles(background_fetch)
+
+    progress.step('Caching images')
+    image_cache.fetchForItems(ingested, background_fetch)
+
+    progress.finish()
+    if verbose:
+        print('\n'.join(writer.report() + ['purged: %d items' % purged] + fever.report()))
+    return writer.stats
+
+
+def profileSync(path=None, full=False, limit=30, refreshed=None):
+    '''
+    Runs refreshAll under cProfile, dumps the profile to path if given and
+    returns the sync stats and the top functions by cumulative time as text
+    '''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        stats = refreshAll(full, refreshed)
+    finally:
+        profiler.disable()
+    if path:
+        profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return stats, out.getvalue()
+
+
+class FaviconCache(object):
+    '''
+    Decoded favicons keyed by favicons.id so each one is decoded once rather
+    than on every cell, least recently used are dropped past the size limit
+    '''
+
+    def __init__(self, size=None):
+        self.size = size or favicon_cache_size
+        self.entries = OrderedDict()  # favicon_id: (raw bytes, ui.Image)
+        self.lock = threading.Lock()
+
+    def get(self, favicon_id):
+        if favicon_id is None:
+            return None
+        with self.lock:
+            if favicon_id in self.entries:
+                self.entries.move_to_end(favicon_id)
+                return self.entries[favicon_id][1]
+
+        with db.reader() as conn:
+            row = conn.execute(
+                'SELECT data FROM favicons WHERE id = ?', (favicon_id,)).fetchone()
+        data = base64.decodebytes(row[0].partition(
+            'base64,')[2].encode('utf-8')) if row else b''
+        # imported here so the core runs where there is no ui module
+        import ui
+        image = ui.Image.from_data(data, 2) if data else None
+
+        with self.lock:
+            self.entries[favicon_id] = (data, image)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return image
+
+    def invalidate(self, favicon_ids=None):
+        with self.lock:
+            if favicon_ids is None:
+                self.entries.clear()
+            for favicon_id in favicon_ids or ():
+                self.entries.pop(favicon_id, None)
+
+
+favicon_cache = FaviconCache()
+
+
+class ArticleCache(object):
+    '''
+    zlib compressed readurl articles on disk, one file per item id. Reading a
+    file bumps its mtime and the oldest files are removed once the directory
+    grows past article_cache_bytes.
+    '''
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or article_cache_dir
+        self.max_bytes = max_bytes or article_cache_bytes
+        self.lock = threading.Lock()
+        self.size = None
+
+    def filename(self, item_id):
+        return os.path.join(self.path, '%d.z' % int(item_id))
+
+    def has(self, item_id):
+        return os.path.exists(self.filename(item_id))
+
+    def get(self, item_id):
+        try:
+            with open(self.filename(item_id), 'rb') as f:
+                data = f.read()
+            os.utime(self.filename(item_id))
+        except OSError:
+            return None
+        return zlib.decompress(data).decode('utf-8')
+
+    def put(self, item_id, text):
+        os.makedirs(self.path, exist_ok=True)
+        data = zlib.compress(text.encode('utf-8'), 6)
+        name = self.filename(item_id)
+        with self.lock:
+            size = self.currentSize()
+            old = os.path.getsize(name) if os.path.exists(name) else 0
+            with open(name + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(name + '.tmp', name)
+            self.size = size + len(data) - old
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def currentSize(self):
+        if self.size is None:
+            self.size = sum(entry.stat().st_size for entry in self.entries())
+        return self.size
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [entry for entry in os.scandir(self.path) if entry.name.endswith('.z')]
+
+    def evict(self):
+        # least recently read first, down to 90% of the cap
+        target = self.max_bytes * 0.9
+        for entry in sorted(self.entries(), key=lambda entry: entry.stat().st_mtime):
+            if self.size <= target:
+                break
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+article_cache = ArticleCache()
+
+
+img_pattern = re.compile(r'''(<img\b[^>]*?\bsrc\s*=\s*["'])(https?://[^"']+)(["'])''', re.I)
+
+
+class ImageCache(object):
+    '''
+    Article images stored content-addressed in image_cache_dir, so the same
+    picture behind several urls is kept once. The images table maps each url
+    to its file. Downloads share one pooled session, image_threads at a time,
+    and the least recently shown files go once image_cache_bytes is passed.
+    '''
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or image_cache_dir
+        self.max_bytes = max_bytes or image_cache_bytes
+        self.session = None
+        self.lock = threading.Lock()
+
+    def httpSession(self):
+        # the download threads all ask for it, one of them builds it
+        with self.lock:
+            if self.session is None:
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=image_threads, pool_maxsize=image_threads)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def filename(self, digest):
+        return os.path.join(self.path, digest)
+
+    def fetchForItems(self, item_ids, background=True):
+        '''
+        Downloads the images referenced by the given items that are not
+        cached yet, in a background thread by default
+        '''
+        item_ids = list(item_ids)
+        if not item_ids:
+            return None
+        if not background:
+            return self.fetch(item_ids)
+        thread = threading.Thread(target=inAccount(self.fetch), args=(item_ids,), daemon=True)
+        thread.start()
+        return thread
+
+    def fetch(self, item_ids):
+        urls = set()
+        with db.reader() as conn:
+            for i in range(0, len(item_ids), 500):
+                chunk = item_ids[i:i + 500]
+                for row in conn.execute('SELECT html FROM items WHERE id IN (' +
+                                        ','.join('?' * len(chunk)) + ')', chunk):
+                    urls.update(match.group(2) for match in img_pattern.finditer(unpackHtml(row[0])))
+            known = set(row[0] for row in conn.execute('SELECT url FROM images'))
+        wanted = sorted(urls - known)
+        if not wanted:
+            return 0
+
+        os.makedirs(self.path, exist_ok=True)
+        stored = 0
+        with ThreadPoolExecutor(max_workers=image_threads) as pool:
+            futures = [pool.submit(inAccount(self.download), url) for url in wanted]
+            for future in as_completed(futures):
+                try:
+                    stored += future.result()
+                except Exception:
+                    # unreachable images stay remote
+                    pass
+        self.evict()
+        return stored
+
+    def download(self, url):
+        r = self.httpSession().get(url, timeout=image_timeout)
+        if r.status_code != 200 or not r.content:
+            return 0
+        data = r.content
+        digest = hashlib.sha1(data).hexdigest()
+        name = self.filename(digest)
+        if not os.path.exists(name):
+            with open(name + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(name + '.tmp', name)
+        with db.writer() as conn:
+            conn.execute('insert or replace into images values (?,?,?,?)',
+                         (url, digest, len(data), int(time.time())))
+        return 1
+
+    def evict(self):
+        with db.writer() as conn:
+            rows = conn.execute('''SELECT hash, max(size), max(last_used) FROM images
+                GROUP BY hash ORDER BY max(last_used) DESC''').fetchall()
+            total = 0
+            for digest, size, last_used in rows:
+                total += size
+                if total > self.max_bytes:
+                    conn.execute('DELETE FROM images WHERE hash = ?', (digest,))
+                    try:
+                        os.remove(self.filename(digest))
+                    except OSError:
+                        pass
+
+    def rewrite(self, html):
+        '''
+        Points the img tags in html at the local copies that exist and marks
+        them as recently used
+        '''
+        if not html:
+            return html
+        urls = set(match.group(2) for match in img_pattern.finditer(html))
+        if not urls:
+            return html
+        with db.reader() as conn:
+            local = dict(conn.execute('SELECT url, hash FROM images WHERE url IN (' +
+                                      ','.join('?' * len(urls)) + ')', list(urls)).fetchall())
+        if not local:
+            return html
+        with db.writer() as conn:
+            conn.execute('UPDATE images SET last_used = ? WHERE url IN (' + ','.join('?' * len(local)) + ')',
+                         [int(time.time())] + list(local))
+
+        def localUrl(match):
+            digest = local.get(match.group(2))
+            if digest is None or not os.path.exists(self.filename(digest)):
+                return match.group(0)
+            return match.group(1) + 'file://' + quote(os.path.abspath(self.filename(digest))) + match.group(3)
+
+        return img_pattern.sub(localUrl, html)
+
+
+image_cache = ImageCache()
+
+
+def fetchArticle(item_id, url):
+    r = requests.get(readurl + url, timeout=prefetch_timeout)
+    if r.status_code == 200 and r.text:
+        article_cache.put(item_id, r.text)
+        return True
+    return False
+
+
+def prefetchArticles(background=True):
+    '''
+    Fetches the newest unread articles through readurl that are not cached
+    yet, prefetch_threads at a time, in a background thread by default
+    '''
+    with db.reader() as conn:
+        rows = conn.execute('''SELECT items.id, items.url FROM items
+            JOIN feeds ON items.feed_id = feeds.id
+            WHERE items.is_read = 0 AND items.is_saved IN (0, 1) AND feeds.is_spark = 0
+            ORDER BY items.created_on_time DESC LIMIT ?''', (prefetch_limit,)).fetchall()
+    wanted = [(row[0], row[1]) for row in rows if row[1] and not article_cache.has(row[0])]
+
+    def run():
+        with ThreadPoolExecutor(max_workers=prefetch_threads) as pool:
+            futures = [pool.submit(inAccount(fetchArticle), item_id, url)
+                       for item_id, url in wanted]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    # offline or a bad page, it is fetched live when opened
+                    pass
+
+    if not background:
+        return run()
+    thread = threading.Thread(target=inAccount(run), daemon=True)
+    thread.start()
+    return thread
+
+
+def encodeString(str):
+    str = str.replace('_eq_', '=')
+    str = str.replace('_and_', '&')
+    str = str.replace('_hash_', '#')
+    str = str.replace('&apos;', '\'')
+    str = str.replace('&middot;', '•')
+    return str
+
+
+def pretty_date(time=False):
+    """
+    Get a datetime object or a int() Epoch timestamp and return a
+    pretty string like 'an hour ago', 'Yesterday', '3 months ago',
+    'just now', etc
+    """
+    from datetime import datetime
+    now = datetime.now()
+    if type(time) is int:
+        diff = now - datetime.fromtimestamp(time)
+    elif isinstance(time, datetime):
+        diff = now - time
+    elif not time:
+        diff = now - now
+    second_diff = diff.seconds
+    day_diff = diff.days
+
+    if day_diff < 0:
+        return ''
+
+    if day_diff == 0:
+        if second_diff < 10:
+            return "just now"
+        if second_diff < 60:
+            return str(round(second_diff)) + " seconds ago"
+        if second_diff < 120:
+            return "a minute ago"
+        if second_diff < 3600:
+            return str(round(second_diff / 60)) + " minutes ago"
+        if second_diff < 7200:
+            return "an hour ago"
+        if second_diff < 86400:
+            return str(round(second_diff / 3600)) + " hours ago"
+    if day_diff == 1:
+        return "Yesterday"
+    if day_diff < 7:
+        return str(round(day_diff)) + " days ago"
+    if day_diff < 31:
+        if round(day_diff / 7) == 1:
+            return str(round(day_diff / 7)) + " week ago"
+        else:
+            return str(round(day_diff / 7)) + " weeks ago"
+    if day_diff < 365:
+        if round(day_diff / 30) == 1:
+            return str(round(day_diff / 30)) + " month ago"
+        else:
+            return str(round(day_diff / 30)) + " months ago"
+    if round(day_diff / 365) == 1:
+        return str(round(day_diff / 365)) + " year ago"
+    else:
+        return str(round(day_diff / 365)) + " years ago"
+
+
+# IN (0, 1) on an unfiltered state column lets sqlite seek idxItemsState on
+# every column instead of stopping at the first unconstrained one
+view_filters = {
+    'Saved': 'items.is_read IN (0, 1) AND items.is_saved = 1',
+    'Unread': 'items.is_read = 0 AND items.is_saved IN (0, 1) AND feeds.is_spark = 0',
+    'All Items': 'items.is_read IN (0, 1) AND items.is_saved IN (0, 1) AND (items.is_saved = 1 OR feeds.is_spark = 0)',
+    'Archived': 'items.is_read = 1 AND items.is_saved = 0'
+}
+
+# the (is_read, is_saved) pairs making up each view and what else the pair
+# needs. Item lists run one branch per pair, so each reads idxItemsAge or
+# idxItemsState already in sort order and a page never sorts the view
+view_states = {
+    'Saved': [(0, 1, ''), (1, 1, '')],
+    'Unread': [(0, 0, 'feeds.is_spark = 0'), (0, 1, 'feeds.is_spark = 0')],
+    'All Items': [(0, 0, 'feeds.is_spark = 0'), (1, 0, 'feeds.is_spark = 0'), (0, 1, ''), (1, 1, '')],
+    'Archived': [(1, 0, '')]
+}
+
+# item_sort_by option: (columns, reverse the direction, result columns used
+# as the page key), items.id always comes last. Feeds are sorted by time
+# within each one so idxItemsState gives the whole order
+sort_columns = {
+    'item_created_on_time': (('items.created_on_time',), False, ('created_on_time',)),
+    'item_created_minsago': (('items.created_on_time',), True, ('created_on_time',)),
+    'feed_id': (('items.feed_id', 'items.created_on_time'), False, ('feed_id', 'created_on_time'))
+}
+
+item_columns = """items.id as item_id, items.title as item_title, items.author as item_author,
+    items.html as item_html, items.url as item_url,
+    items.created_on_time as created_on_time,
+    items.feed_id as feed_id, feeds.title as feed_title, feeds.favicon_id as favicon_id"""
+
+# what an item list row needs, the html is left for getItemHtml
+item_list_columns = """items.id as item_id, items.title as item_title, items.author as item_author, items.url as item_url,
+    items.created_on_time as created_on_time,
+    items.feed_id as feed_id, feeds.title as feed_title, feeds.favicon_id as favicon_id"""
+
+
+def checkViewType(view_type):
+    if view_type not in view_filters:
+        raise ValueError('unknown view_type %r, expected one of %s' %
+                         (view_type, ', '.join(view_filters)))
+    return view_type
+
+
+def itemFilter(view_type, group_id='%', feed_id='%'):
+    # WHERE clause and params scoping items to a view, group and feed
+    scope_sql, params = scopeFilter(group_id, feed_id)
+    return view_filters[checkViewType(view_type)] + scope_sql, params
+
+
+def scopeFilter(group_id='%', feed_id='%'):
+    # the group and feed part of itemFilter, each condition starts with AND
+    group_id = str(group_id)
+    feed_id = str(feed_id)
+    sql = ''
+    params = []
+    if group_id == '0':
+        sql += ' AND NOT EXISTS (SELECT 1 FROM feeds_group WHERE feed_id = items.feed_id)'
+    elif group_id != '%':
+        sql += ' AND EXISTS (SELECT 1 FROM feeds_group WHERE feed_id = items.feed_id AND group_id = ?)'
+        params.append(int(group_id))
+    if feed_id != '%':
+        sql += ' AND items.feed_id = ?'
+        params.append(int(feed_id))
+    return sql, params
+
+
+def buildItemQuery(view_type, group_id='%', feed_id='%', sort_by=None, sort_direction=None, columns=None, after=None, limit=None):
+    '''
+    Returns (sql, params) for a single view_type/group/feed/sort combination,
+    '%' for group_id or feed_id means all of them. after is the page key, the
+    sort keys and id, of the last row already shown and limit the page size.
+    '''
+    group_id = str(group_id)
+    if group_id == '%':
+        group_sql = """coalesce((SELECT min(group_id) FROM feeds_group WHERE feed_id = items.feed_id), 0)"""
+        group_params = []
+    else:
+        group_sql = '?'
+        group_params = [int(group_id)] * 2
+    scope_sql, scope_params = scopeFilter(group_id, feed_id)
+
+    columns_sql, reverse, keys = sort_columns[sort_by or item_sort_by]
+    direction = (sort_direction or item_sort_direction).upper()
+    if reverse:
+        direction = 'ASC' if direction == 'DESC' else 'DESC'
+    if after is not None:
+        pairs = list(zip(columns_sql + ('items.id',), after))
+        if str(feed_id) != '%':
+            # a fixed feed left in the key would stop sqlite seeking on feed_id
+            pairs = [(column, value) for column, value in pairs if column != 'items.feed_id']
+        scope_sql += ' AND (' + ', '.join(column for column, value in pairs) + ') ' + \
+            ('>' if direction == 'ASC' else '<') + ' (' + ', '.join('?' * len(pairs)) + ')'
+        scope_params = scope_params + [value for column, value in pairs]
+
+    branches = []
+    params = []
+    for is_read, is_saved, extra_sql in view_states[checkViewType(view_type)]:
+        branches.append('SELECT ' + (columns or item_columns) + """,
+    """ + group_sql + """ as group_id,
+    coalesce((SELECT title FROM groups WHERE id = """ + group_sql + """), 'No Group') as group_title
+    FROM items
+    LEFT OUTER JOIN feeds
+    ON items.feed_id = feeds.id
+    WHERE items.is_read = %d AND items.is_saved = %d""" % (is_read, is_saved) +
+            (' AND ' + extra_sql if extra_sql else '') + scope_sql)
+        params.extend(group_params + scope_params)
+    # the branches are merged in order, sorting on the result columns
+    sql = '\n    UNION ALL '.join(branches)
+    sql += ' ORDER BY ' + ', '.join(key + ' ' + direction for key in keys + ('item_id',))
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
+
+
+def checkQueryPlans():
+    '''
+    Runs EXPLAIN QUERY PLAN over every view/group/feed/sort combination and
+    returns the plan lines that scan items or feeds, with or without an index
+    '''
+    with db.reader() as conn:
+        return queryPlanScans(conn)
+
+
+# EXPLAIN QUERY PLAN lines that visit every row, older sqlite says SCAN TABLE,
+# or that sort the whole view before the first row of a page comes back
+plan_scan_re = re.compile(r'SCAN (TABLE )?(items|feeds)\b|USE TEMP B-TREE')
+
+
+def queryPlanScans(conn):
+    group_id = conn.execute('SELECT group_id FROM feeds_group LIMIT 1').fetchone()
+    feed_id = conn.execute('SELECT id FROM feeds LIMIT 1').fetchone()
+    groups = ['%', 0] + ([group_id[0]] if group_id else [])
+    feeds = ['%'] + ([feed_id[0]] if feed_id else [])
+    full_scans = []
+    for view in view_filters:
+        for group in groups:
+            for feed in feeds:
+                for sort_by in sort_columns:
+                    after = (0,) * (len(sort_columns[sort_by][2]) + 1)
+                    sql, params = buildItemQuery(view, group, feed, sort_by, 'ASC',
+                                                 item_list_columns, after, item_page_size)
+                    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+                        detail = row[-1]
+                        # walking a whole index is as bad as the table, only SEARCH in order is fine
+                        if plan_scan_re.match(detail):
+                            full_scans.append((view, group, feed, sort_by, detail))
+    return full_scans
+
+
+@lru_cache(maxsize=512)
+def dayLabel(days_ago):
+    if days_ago <= 0:
+        return 'Today'
+    return pretty_date(datetime.now() - timedelta(days=days_ago))
+
+
+def dateBuckets(epochs):
+    '''
+    Returns a section label for each epoch in one pass, bucketed by local
+    calendar day. Labels are memoized per day so pretty_date runs once a day.
+    '''
+    midnight = int(time.mktime(datetime.now().date().timetuple()))
+    labels = []
+    for epoch in epochs:
+        if epoch is None or epoch >= midnight:
+            days_ago = 0
+        else:
+            days_ago = (midnight - epoch - 1) // 86400 + 1
+        labels.append(dayLabel(days_ago))
+    return labels
+
+
+class ItemList(object):
+    '''
+    Item list rows held column by column. Ids, epochs, feed and group ids
+    are arrays, titles and urls are lists, and feed and group details are
+    kept once per feed and group. Rows are sectioned by group_by as they
+    arrive, each section a range of row indices, or an array of them once
+    its rows stop being next to each other. Indexing returns the row as a
+    dict, built when asked for.
+    '''
+
+    def __init__(self, grouping=None):
+        self.grouping = grouping or group_by
+        self.ids = array('q')
+        self.epochs = array('q')
+        self.feed_ids = array('q')
+        self.group_ids = array('q')
+        self.titles = []
+        self.urls = []
+        self.authors = []
+        # feed_id: (title, favicon_id), group_id: title
+        self.feeds = {}
+        self.groups = {}
+        self.section_titles = []
+        self.section_rows = []
+        self.section_index = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        feed_id = self.feed_ids[index]
+        group_id = self.group_ids[index]
+        epoch = self.epochs[index]
+        feed_title, favicon_id = self.feeds[feed_id]
+        return {
+            'favicon_id': favicon_id,
+            'title': self.titles[index],
+            'url': self.urls[index],
+            'dt': epoch if epoch != -1 else None,
+            'id': self.ids[index],
+            'item_author': self.authors[index],
+            'group_id': group_id,
+            'group_title': self.groups[group_id],
+            'feed_id': feed_id,
+            'feed_title': feed_title
+        }
+
+    def extend(self, rows):
+        start = len(self.ids)
+        for row in rows:
+            feed_id = row['feed_id'] or 0
+            group_id = row['group_id']
+            epoch = row['created_on_time']
+            author = row['item_author']
+            self.ids.append(row['item_id'])
+            self.epochs.append(epoch if epoch is not None else -1)
+            self.feed_ids.append(feed_id)
+            self.group_ids.append(group_id)
+            self.titles.append(encodeString(row['item_title']))
+            self.urls.append(row['item_url'])
+            # authors repeat down a list, keep one copy of each
+            self.authors.append(sys.intern(author) if author else author)
+            if feed_id not in self.feeds:
+                self.feeds[feed_id] = (row['feed_title'], row['favicon_id'])
+            if group_id not in self.groups:
+                self.groups[group_id] = row['group_title']
+        self.addSections(start)
+
+    def addSections(self, start):
+        if self.grouping == 'date':
+            epochs = (epoch if epoch != -1 else None for epoch in self.epochs[start:])
+            titles = (label.upper() for label in dateBuckets(epochs))
+        elif self.grouping == 'group':
+            titles = (self.groups[group_id] for group_id in self.group_ids[start:])
+        elif self.grouping == 'feed':
+            titles = (self.feeds[feed_id][0] for feed_id in self.feed_ids[start:])
+        for index, title in enumerate(titles, start):
+            section = self.section_index.get(title)
+            if section is None:
+                self.section_index[title] = len(self.section_titles)
+                self.section_titles.append(title)
+                self.section_rows.append(range(index, index + 1))
+                continue
+            rows = self.section_rows[section]
+            if isinstance(rows, range):
+                if rows.stop == index:
+                    self.section_rows[section] = range(rows.start, index + 1)
+                    continue
+                rows = self.section_rows[section] = array('q', rows)
+            rows.append(index)
+
+    def sectionCount(self):
+        return len(self.section_titles)
+
+    def sectionTitle(self, section):
+        return self.section_titles[section]
+
+    def sectionLength(self, section):
+        return len(self.section_rows[section])
+
+    def sectionRow(self, section, row):
+        return self[self.section_rows[section][row]]
+
+
+@instrumented
+def getData(view_type, group_id, feed_id):
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(*buildItemQuery(view_type, group_id, feed_id, columns=item_list_columns))
+        items = ItemList()
+        items.extend(c)
+    return items
+
+
+@instrumented
+def getGroups():
+    checkViewType(view_type)
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT counts.group_id, coalesce(groups.title, 'No Group') as group_title, sum(counts.item_count) as group_count
+            FROM counts LEFT OUTER JOIN groups ON counts.group_id = groups.id
+            WHERE counts.view_type = ? AND counts.item_count > 0
+            GROUP BY counts.group_id ORDER BY group_title""", (view_type,))
+        rows = c.fetchall()
+        groups = []
+        if len(rows) > 0:
+            groups.append(
+                {'favicon_id': None,
+                 'title': view_type + ' (' + str(countTotal(conn, view_type)) + ')', 'group_id': '%', 'feed_id': '%'})
+            for row in rows:
+                groups.append(
+                    {
+                        'favicon_id': None,
+                        'title': encodeString(row['group_title']) + ' (' + str(row['group_count']) + ')',
+                        'url': '',
+                        'dt': '',
+                        'id': '',
+                        'item_author': '',
+                        'item_html': '',
+                        'group_id': row['group_id'],
+                        'feed_id': '%'
+                    })
+    return groups
+
+
+@instrumented
+def getFeeds(group_id, feed_id):
+    checkViewType(view_type)
+    with db.reader() as conn:
+        c = conn.cursor()
+        sql = """SELECT counts.group_id, counts.feed_id, coalesce(feeds.title, '') as feed_title, feeds.favicon_id as favicon_id,
+            max(counts.item_count) as feed_count
+            FROM counts LEFT OUTER JOIN feeds ON counts.feed_id = feeds.id
+            WHERE counts.view_type = ? AND counts.item_count > 0"""
+        params = [view_type]
+        if str(group_id) != '%':
+            sql += " AND counts.group_id = ?"
+            params.append(group_id)
+        c.execute(sql + " GROUP BY counts.feed_id ORDER BY feed_title", params)
+        rows = c.fetchall()
+        feeds = []
+        if len(rows) > 0:
+            feeds.append(
+                {'favicon_id': None, 'title':  view_type + ' Feeds (' + str(sum(row['feed_count'] for row in rows)) + ')', 'group_id': group_id, 'feed_id': feed_id})
+            for row in rows:
+                feeds.append(
+                    {
+                        'favicon_id': row['favicon_id'],
+                        'title': encodeString(row['feed_title']) + ' (' + str(row['feed_count']) + ')',
+                        'url': '',
+                        'dt': '',
+                        'id': '',
+                        'item_author': '',
+                        'item_html': '',
+                        'group_id': row['group_id'],
+                        'feed_id': row['feed_id']
+                    })
+    return feeds
+
+
+@instrumented
+def getItems(group_id, feed_id):
+    # the whole list at once, bodies are left for getItemHtml
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(*buildItemQuery(view_type, group_id, feed_id, columns=item_list_columns))
+        items = ItemList()
+        items.extend(c)
+    return items
+
+
+@instrumented
+def getItemsPage(group_id, feed_id, after=None, limit=None, items=None):
+    '''
+    Adds one page of list rows to items, a new ItemList by default, and
+    returns it with the key to pass as after for the next page, or None once
+    the list is exhausted
+    '''
+    limit = limit or item_page_size
+    items = items if items is not None else ItemList()
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(*buildItemQuery(view_type, group_id, feed_id,
+                                  columns=item_list_columns, after=after, limit=limit))
+        rows = c.fetchall()
+        items.extend(rows)
+        next_key = None
+        if len(rows) == limit:
+            keys = sort_columns[item_sort_by][2]
+            next_key = tuple(rows[-1][key] for key in keys) + (rows[-1]['item_id'],)
+    return items, next_key
+
+
+@instrumented
+def getItemHtml(id):
+    with db.reader() as conn:
+        row = conn.execute(
+            'SELECT html FROM items WHERE id = ?', (id,)).fetchone()
+    return unpackHtml(row[0]) if row else ''
+
+
+def htmlStorageStats(conn, sample=200):
+    '''
+    Database size, how many bodies are stored as text or compressed, and
+    the time taken to decode a sample of articles
+    '''
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    stats = {'file_bytes': pages * page_size, 'used_bytes': (pages - free) * page_size}
+    for kind, count, size in conn.execute(
+            "SELECT typeof(html), count(*), sum(length(html)) FROM items GROUP BY 1"):
+        stats[kind + '_rows'] = count
+        stats[kind + '_bytes'] = size or 0
+    timings = []
+    for row in conn.execute('SELECT html FROM items ORDER BY id DESC LIMIT ?', (sample,)):
+        start = time.perf_counter()
+        unpackHtml(row[0])
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    if timings:
+        stats['decode_ms_mean'] = sum(timings) / len(timings)
+        stats['decode_ms_p95'] = timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0]
+        stats['decode_ms_max'] = timings[-1]
+    return stats
+
+
+def migrateHtmlStorage(vacuum=False):
+    '''
+    Compresses the html of items still stored as text, a batch per
+    transaction so readers and syncs are not held up, and returns the
+    storage stats from before and after
+    '''
+    with db.reader() as conn:
+        before = htmlStorageStats(conn)
+    migrated = 0
+    last_id = -1
+    while compress_html:
+        with db.writer() as conn:
+            rows = conn.execute("SELECT id, html FROM items WHERE id > ? AND typeof(html) = 'text' ORDER BY id LIMIT ?",
+                                (last_id, html_migrate_batch)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            packed = [(html, item_id) for item_id, html in
+                      ((row[0], packHtml(row[1])) for row in rows) if isinstance(html, bytes)]
+            conn.execute('BEGIN')
+            conn.executemany('UPDATE items SET html = ? WHERE id = ?', packed)
+            conn.execute('COMMIT')
+            migrated += len(packed)
+    if vacuum and migrated:
+        with db.writer() as conn:
+            conn.execute('VACUUM')
+    with db.reader() as conn:
+        after = htmlStorageStats(conn)
+    report = {'migrated': migrated, 'before': before, 'after': after}
+    if verbose:
+        print('\n'.join(htmlStorageReport(report)))
+    return report
+
+
+def htmlStorageReport(report):
+    lines = ['html migrated: %d items' % report['migrated']]
+    for stage in ('before', 'after'):
+        stats = report[stage]
+        lines.append('%-6s file %9d bytes, used %9d bytes, text %d rows %d bytes, blob %d rows %d bytes, decode mean %.3fms p95 %.3fms' % (
+            stage, stats['file_bytes'], stats['used_bytes'],
+            stats.get('text_rows', 0), stats.get('text_bytes', 0),
+            stats.get('blob_rows', 0), stats.get('blob_bytes', 0),
+            stats.get('decode_ms_mean', 0), stats.get('decode_ms_p95', 0)))
+    return lines
+
+
+def searchAvailable(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone() is not None
+
+
+def searchQuery(text, op=' '):
+    # quote each word so user input can't break the fts5 syntax, prefix match the last
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if words:
+        words[-1] += '*'
+    return op.join(words)
+
+
+def searchSnippets(text, bodies):
+    '''
+    Snippets for one page of results, {item_id: snippet}. The index keeps no
+    text, so the page's bodies go through a scratch fts5 table with the same
+    tokenizer and any of the words is highlighted. A body without them,
+    where the title or author matched, starts the snippet instead.
+    '''
+    scratch = sqlite3.connect(':memory:')
+    try:
+        scratch.execute("CREATE VIRTUAL TABLE page USING fts5 (body, tokenize='porter unicode61')")
+        scratch.executemany('INSERT INTO page (rowid, body) VALUES (?, ?)', bodies.items())
+        snippets = dict(scratch.execute("SELECT rowid, snippet(page, 0, '<b>', '</b>', '…', 12) FROM page WHERE page MATCH ?",
+                                        (searchQuery(text, ' OR '),)))
+    finally:
+        scratch.close()
+    for item_id, body in bodies.items():
+        if item_id not in snippets:
+            words = body.split()
+            snippets[item_id] = ' '.join(words[:12]) + ('…' if len(words) > 12 else '')
+    return snippets
+
+
+@instrumented
+def searchItems(text, group_id='%', feed_id='%', page=0, limit=None):
+    '''
+    Ranked full-text search within the current view_type and the same
+    group/feed scopes as getItems. Returns one page of rows with a snippet.
+    '''
+    limit = limit or search_page_size
+    match = searchQuery(text)
+    if not match:
+        return []
+    where_sql, params = itemFilter(view_type, group_id, feed_id)
+    with db.reader() as conn:
+        if not searchAvailable(conn):
+            return []
+        rows = conn.execute("""SELECT items.id as item_id, items.title as item_title, items.author as item_author,
+            items.url as item_url, items.created_on_time as created_on_time,
+            items.feed_id as feed_id, feeds.title as feed_title, feeds.favicon_id as favicon_id,
+            items.html as html
+            FROM items_fts
+            JOIN items ON items.id = items_fts.rowid
+            LEFT OUTER JOIN feeds ON items.feed_id = feeds.id
+            WHERE items_fts MATCH ? AND """ + where_sql + """
+            ORDER BY bm25(items_fts, 10.0, 5.0, 1.0)
+            LIMIT ? OFFSET ?""", [match] + params + [limit, page * limit]).fetchall()
+    snippets = searchSnippets(text, OrderedDict((row['item_id'], stripHtml(row['html'])) for row in rows))
+    results = []
+    for row in rows:
+        results.append(
+            {
+                'favicon_id': row['favicon_id'],
+                'title': encodeString(row['item_title'] or ''),
+                'url': row['item_url'],
+                'dt': row['created_on_time'],
+                'id': row['item_id'],
+                'item_author': row['item_author'],
+                'feed_id': row['feed_id'],
+                'feed_title': row['feed_title'],
+                'snippet': snippets[row['item_id']]
+            })
+    return results
+
+
+# items covered by read marks that have not reached the server yet
+outbox_pending_reads_sql = '''DELETE FROM temp.unread_ids WHERE id IN (
+    SELECT target_id FROM outbox WHERE mark = 'item' AND as_state = 'read'
+    UNION SELECT items.id FROM outbox JOIN items ON items.feed_id = outbox.target_id
+    WHERE outbox.mark = 'feed' AND outbox.as_state = 'read' AND items.created_on_time <= outbox.before
+    UNION SELECT items.id FROM outbox JOIN feeds_group ON feeds_group.group_id = outbox.target_id
+    JOIN items ON items.feed_id = feeds_group.feed_id
+    WHERE outbox.mark = 'group' AND outbox.as_state = 'read' AND items.created_on_time <= outbox.before)'''
+
+
+class Outbox(object):
+    '''
+    Durable queue of mark calls for the Fever API. Local state is updated
+    straight away by the caller, a background thread sends the queued calls,
+    merging redundant ones first and backing off while the server is
+    unreachable.
+    '''
+
+    def __init__(self):
+        self.wake = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def enqueue(self, conn, mark, as_state, target_id, before=None):
+        conn.execute('''INSERT INTO outbox (mark, as_state, target_id, before, created)
+            VALUES (?,?,?,?,?)''', (mark, as_state, int(target_id), before, int(time.time())))
+
+    def kick(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=inAccount(self.run), daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            self.flush()
+            with db.reader() as conn:
+                row = conn.execute(
+                    'SELECT min(next_attempt) FROM outbox').fetchone()
+            if row[0] is None:
+                self.wake.wait()
+            else:
+                self.wake.wait(max(1, row[0] - time.time()))
+
+    def coalesce(self, conn, rows):
+        '''
+        Returns the rows worth sending and the ids of the rows they make
+        redundant: repeats of the same mark, a later mark on the same
+        target replacing an earlier one, and item reads covered by a feed or
+        group read with a later before
+        '''
+        latest = OrderedDict()
+        dropped = []
+        for row in rows:
+            kind = 'read' if row['as_state'] in ('read', 'unread') else 'saved'
+            key = (row['mark'], kind, row['target_id'])
+            if key in latest:
+                dropped.append(latest[key]['id'])
+            latest[key] = row
+
+        feeds_before = {}
+        groups_before = {}
+        for (mark, kind, target_id), row in latest.items():
+            if kind == 'read' and row['as_state'] == 'read' and mark in ('feed', 'group'):
+                covers = feeds_before if mark == 'feed' else groups_before
+                covers[target_id] = max(covers.get(target_id, 0), row['before'] or 0)
+
+        send = []
+        for (mark, kind, target_id), row in latest.items():
+            if mark == 'item' and row['as_state'] == 'read' and (feeds_before or groups_before):
+                item = conn.execute(
+                    'SELECT feed_id, created_on_time FROM items WHERE id = ?', (target_id,)).fetchone()
+                if item is not None:
+                    groups = [g[0] for g in conn.execute(
+                        'SELECT group_id FROM feeds_group WHERE feed_id = ?', (item[0],))]
+                    befores = [feeds_before.get(item[0], 0)] + \
+                        [groups_before.get(g, 0) for g in groups]
+                    if item[1] is not None and item[1] <= max(befores):
+                        dropped.append(row['id'])
+                        continue
+            send.append(row)
+        return send, dropped
+
+    def flush(self):
+        '''
+        One pass over the due marks, returns how many were sent
+        '''
+        with self.flush_lock:
+            now = int(time.time())
+            with db.reader() as conn:
+                rows = conn.execute('''SELECT * FROM outbox ORDER BY id''').fetchall()
+                send, dropped = self.coalesce(conn, rows)
+            if dropped:
+                with db.writer() as conn:
+                    conn.executemany('DELETE FROM outbox WHERE id = ?',
+                                     [(i,) for i in dropped])
+
+            sent = 0
+            for row in send:
+                if row['next_attempt'] > now:
+                    continue
+                data = {'mark': row['mark'], 'as': row['as_state'], 'id': row['target_id']}
+                if row['before'] is not None:
+                    data['before'] = row['before']
+                try:
+                    fever.post('', data)
+                    ok = True
+                except Exception:
+                    ok = False
+                with db.writer() as conn:
+                    if ok:
+                        conn.execute('DELETE FROM outbox WHERE id = ?', (row['id'],))
+                        sent += 1
+                    else:
+                        delay = min(outbox_max_retry_seconds,
+                                    outbox_retry_seconds * 2 ** row['attempts'])
+                        conn.execute('UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ?',
+                                     (now + delay, row['id']))
+                if not ok:
+                    # the server is likely unreachable, leave the rest for the retry
+                    break
+            return sent
+
+
+outbox = Outbox()
+
+
+class SyncScheduler(object):
+    '''
+    Runs refreshAll off the UI thread. While the server has nothing new it
+    only syncs read and saved state, backing off up to sync_state_interval,
+    and otherwise waits about as long as the feeds usually take to update
+    '''
+
+    def __init__(self):
+        self.wake = threading.Event()
+        self.forced = False
+        self.interval = sync_min_interval
+        self.thread = None
+        self.on_sync = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=inAccount(self.run), daemon=True)
+            self.thread.start()
+
+    def syncNow(self):
+        self.forced = True
+        self.start()
+        self.wake.set()
+
+    def feedInterval(self, conn):
+        '''
+        Average gap between the most recent feed updates, clamped to the
+        configured bounds
+        '''
+        times = [row[0] for row in conn.execute(
+            'SELECT last_updated_on_time FROM feeds WHERE last_updated_on_time > 0 ORDER BY last_updated_on_time DESC LIMIT 20')]
+        if len(times) < 2:
+            return sync_min_interval
+        gap = (times[0] - times[-1]) / (len(times) - 1)
+        return min(sync_max_interval, max(sync_min_interval, gap))
+
+    def step(self):
+        '''
+        One poll and sync, returns the stats of the sync. Groups, feeds and
+        favicons are only downloaded when the server has refreshed, the item
+        ids and read/saved state every time.
+        '''
+        forced, self.forced = self.forced, False
+        changed = False
+        refreshed = None
+        if not forced:
+            refreshed = pollServer()
+            with db.reader() as conn:
+                changed = refreshed != lastRefreshed(conn)
+        # the poll is handed on, a forced sync polls inside refreshAll instead
+        if profile_sync:
+            stats, profile = profileSync(profile_sync, full=changed, refreshed=refreshed)
+            if verbose:
+                print(profile)
+        else:
+            stats = refreshAll(full=changed, refreshed=refreshed)
+        if changed or forced:
+            with db.reader() as conn:
+                self.interval = self.feedInterval(conn)
+        else:
+            self.interval = min(sync_state_interval, self.interval * sync_backoff)
+        if self.on_sync:
+            self.on_sync()
+        return stats
+
+    def run(self):
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                self.interval = min(sync_max_interval, self.interval * sync_backoff)
+                if verbose:
+                    print('sync failed: %s' % e)
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+
+sync_scheduler = SyncScheduler()
+
+
+class Account(object):
+    '''
+    One Fever login with its own database file, connections, api client,
+    outbox, scheduler and caches. Module level functions work on the
+    account entered with using(), the default one otherwise.
+    '''
+
+    def __init__(self, name, baseurl=None, email='', pword='', path=None, **parts):
+        self.name = name
+        self.baseurl = baseurl
+        key = hashlib.md5(str(email + ':' + pword).encode('utf-8')).hexdigest()
+        root, ext = os.path.splitext(fvr_db)
+        self.path = path or '%s-%s%s' % (root, name, ext)
+        self.db = parts.get('db') or ConnectionManager(self.path)
+        self.fever = parts.get('fever') or FeverClient(baseurl, {'api_key': key})
+        self.outbox = parts.get('outbox') or Outbox()
+        self.sync_scheduler = parts.get('sync_scheduler') or SyncScheduler()
+        self.favicon_cache = parts.get('favicon_cache') or FaviconCache()
+        self.article_cache = parts.get('article_cache') or ArticleCache(os.path.join(article_cache_dir, name))
+        self.image_cache = parts.get('image_cache') or ImageCache(os.path.join(image_cache_dir, name))
+
+    def url(self):
+        return self.baseurl or (baseurl if self is default_account else '')
+
+    def sync(self, full=False):
+        with using(self):
+            return refreshAll(full)
+
+    def startSync(self):
+        with using(self):
+            self.sync_scheduler.syncNow()
+
+
+# the settings at the top of this file, it keeps using fvr_db and the cache
+# directories as they are
+default_account = Account('default', path=fvr_db, db=db, fever=fever, outbox=outbox,
+                          sync_scheduler=sync_scheduler, favicon_cache=favicon_cache,
+                          article_cache=article_cache, image_cache=image_cache)
+accounts = OrderedDict([('default', default_account)])
+
+db = AccountProxy('db')
+fever = AccountProxy('fever')
+outbox = AccountProxy('outbox')
+sync_scheduler = AccountProxy('sync_scheduler')
+favicon_cache = AccountProxy('favicon_cache')
+article_cache = AccountProxy('article_cache')
+image_cache = AccountProxy('image_cache')
+
+
+def addAccount(name, baseurl, email='', pword='', path=None):
+    '''
+    Registers an account and makes sure its database exists
+    '''
+    account = Account(name, baseurl, email, pword, path)
+    with using(account):
+        migrateDb()
+    accounts[name] = account
+    return account
+
+
+def loadAccounts():
+    for name, settings in fever_accounts.items():
+        if name not in accounts:
+            addAccount(name, settings.get('baseurl'), settings.get('email', ''),
+                       settings.get('pword', ''), settings.get('path'))
+    return list(accounts.values())
+
+
+def syncAll(full=False, names=None):
+    '''
+    Syncs every account that has a url at the same time, each one only
+    takes its own database's write lock. Returns name: stats, or the
+    exception for an account that failed.
+    '''
+    targets = [account for account in accounts.values()
+               if account.url() and (names is None or account.name in names)]
+    results = OrderedDict()
+    if not targets:
+        return results
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = OrderedDict((account.name, pool.submit(account.sync, full)) for account in targets)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+    return results
+
+
+def accountCounts(view=None):
+    '''
+    Item counts per account for the view, view_type by default. Each comes
+    from that account's counts table on a reader, so running syncs are not
+    waited on.
+    '''
+    view = view or view_type
+    rows = []
+    for account in accounts.values():
+        with account.db.reader() as conn:
+            count = countTotal(conn, view)
+        rows.append({'account': account.name, 'title': '%s (%d)' % (account.name, count), 'count': count})
+    return rows
+
+
+@instrumented
+def markAsRead(mark, id):
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT last_refreshed_on_time FROM last_refreshed_on_time;")
+        row = c.fetchone()
+
+        if row[0] != 0:
+            last_refreshed_on_time = row[0]
+        else:
+            last_refreshed_on_time = int(time.time())
+
+        changed = 0
+        c.execute('BEGIN')
+        if mark == 'item':
+            c.execute('UPDATE items SET is_read = 1 WHERE id = ?', (id,))
+            changed = c.rowcount
+            outbox.enqueue(conn, mark, 'read', id)
+        elif mark == 'group':
+            c.execute('UPDATE items SET is_read = 1 WHERE id in (SELECT items.id FROM items LEFT OUTER JOIN feeds ON items.feed_id = feeds.id LEFT OUTER JOIN feeds_group ON feeds.id = feeds_group.feed_id LEFT OUTER JOIN groups ON feeds_group.group_id = groups.id WHERE items.is_read = 0 and feeds.is_spark = 0 and feeds_group.group_id =?)', (id,))
+            changed = c.rowcount
+            outbox.enqueue(conn, mark, 'read', id, last_refreshed_on_time)
+        elif mark == 'feed':
+            c.execute('UPDATE items SET is_read = 1 WHERE id in (SELECT items.id FROM items LEFT OUTER JOIN feeds ON items.feed_id = feeds.id LEFT OUTER JOIN feeds_group ON feeds.id = feeds_group.feed_id LEFT OUTER JOIN groups ON feeds_group.group_id = groups.id WHERE items.is_read = 0 and feeds.is_spark = 0 and feeds_group.feed_id =?)', (id,))
+            changed = c.rowcount
+            outbox.enqueue(conn, mark, 'read', id, last_refreshed_on_time)
+        c.execute('COMMIT')
+    outbox.kick()
+    return changed
+
+
+def dbStats():
+    '''
+    Row counts, items per view, pending marks and the size on disk
+    '''
+    stats = OrderedDict()
+    with db.reader() as conn:
+        stats['last_refreshed_on_time'] = lastRefreshed(conn)
+        for table in ('groups', 'feeds', 'items', 'outbox', 'images'):
+            stats[table] = conn.execute('SELECT count(*) FROM ' + table).fetchone()[0]
+        stats['views'] = OrderedDict((view, countTotal(conn, view)) for view in view_filters)
+    stats['file_bytes'] = sum(os.path.getsize(db.path + suffix) for suffix in ('', '-wal')
+                              if os.path.exists(db.path + suffix))
+    return stats
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='feverista_core.py', description='Headless Feverista° sync')
+    parser.add_argument('--db', help='database file of the default account, default %s' % fvr_db)
+    parser.add_argument('--account', action='append', metavar='NAME',
+                        help='only this account, can be repeated, default all of them')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every sync phase and the api stats')
+    commands = parser.add_subparsers(dest='command')
+    sync = commands.add_parser('sync', help='sync with the Fever servers, all accounts at once')
+    sync.add_argument('--full', action='store_true', help='download groups, feeds and favicons even if unchanged')
+    sync.add_argument('--profile', metavar='FILE', help='sync one account under cProfile and dump the profile to FILE')
+    stats = commands.add_parser('stats', help='show what is in the databases')
+    stats.add_argument('--json', action='store_true', help='print as JSON')
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 2
+
+    global verbose, background_fetch
+    if args.db:
+        default_account.db = ConnectionManager(args.db)
+    if args.verbose:
+        verbose = True
+        instruments.addSink(logSink)
+    # nothing is left running in the background when the process exits
+    background_fetch = False
+    migrateDb()
+    loadAccounts()
+    selected = [account for account in accounts.values()
+                if not args.account or account.name in args.account]
+    if not selected:
+        print('no account named %s' % ', '.join(args.account))
+        return 2
+
+    status = 0
+    if args.command == 'sync':
+        selected = [account for account in selected if account.url()]
+        if not selected:
+            print('baseurl is not set in feverista_core.py')
+            return 2
+        start = time.perf_counter()
+        if args.profile:
+            with using(selected[0]):
+                results = {selected[0].name: profileSync(args.profile, args.full)[0]}
+        else:
+            results = syncAll(args.full, [account.name for account in selected])
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                print('%s: sync failed: %s' % (name, result))
+                status = 1
+            else:
+                print('%s: synced %d rows' % (name, sum(count for count, secs in result.values())))
+        print('done in %.1fs' % (time.perf_counter() - start))
+        for account in selected:
+            with using(account):
+                runBackgroundMigrations()
+    elif args.command == 'stats':
+        results = OrderedDict()
+        for account in selected:
+            with using(account):
+                results[account.name] = dbStats()
+        if args.json:
+            print(json.dumps(results, indent=1))
+        for name, result in ([] if args.json else results.items()):
+            refreshed = result['last_refreshed_on_time']
+            print('%s, last refreshed %s' % (name, datetime.fromtimestamp(refreshed).isoformat(' ') if refreshed else 'never'))
+            for key in ('groups', 'feeds', 'items', 'outbox', 'images'):
+                print('  %-15s %d' % (key, result[key]))
+            for view, count in result['views'].items():
+                print('  %-15s %d' % (view, count))
+            print('  %-15s %.1f MB' % ('database', result['file_bytes'] / 1e6))
+    for account in accounts.values():
+        account.db.close()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())